@@ -1,4 +1,5 @@
-from dash import Dash, dcc, html, dash_table, callback_context
+from dash import Dash, dcc, html, dash_table, callback_context, Patch, no_update
+from dash.exceptions import PreventUpdate
 from dash.dependencies import Input, Output, State
 import dash_datetimepicker
 import dash_bootstrap_components as dbc
@@ -10,165 +11,59 @@ from datetime import datetime as dt
 from datetime import timedelta
 import pandas as pd
 import geopandas as gpd
-import movingpandas as mpd
 import re
 import json
+import flask
+import hashlib
 import numpy as np
+import heapq
+from collections import OrderedDict
+from functools import lru_cache
+from shapely.geometry import shape, Point
 
 # Plotly mapbox API token
 import config_mapbox
 mapbox_accesstoken = config_mapbox.key
 
+from preprocess import LEVELS_OF_DETAIL, get_online_stores, load_frames, od_what_if_minutes
+
 #############################################################################################
 # Load and preprocess data:
 
-# Grocery Stores scraped from Google Maps
-stores = pd.read_csv('../Data/All_Food_Stores_Features.csv', index_col=0)
-# Only keep important columns for display
-stores.rename(columns = {
-    'Descript': 'Description',
-    'G_MAP_URL': 'Google Maps URL',
-    }, inplace=True)
-
-specific_store_type = stores['Type'].copy()
-stores.insert(4, 'Specific Type', specific_store_type)
+# Frames are preprocessed by preprocess.py and loaded from its binary columnar cache
+frames = load_frames()
+stores = frames['stores']
+od = frames['od']
+individuals = frames['individuals']
+trajectories = frames['trajectories']
+knox_bg = frames['knox_bg']
+prisms = frames['prisms']
+knox_bg_lods = frames['knox_bg_lods']
+prisms_lods = frames['prisms_lods']
 
 # Google Maps POI Type; use ['Store_Type'] for greater simplification of store type (Grocery, Convenience, and Wholesale)
-all_options = list(stores['Type'].unique())
+all_options = list(stores['Specific Type'].unique())
 # Dictionary of POI types for filtering in dashboard
 dictOfOptions = dict(zip(all_options, all_options))
 dictOfOptions = [{key : value} for key, value in dictOfOptions.items()]
 
 stores_table_columns = ['Name', 'Rating', 'Price', 'Type', 'Specific Type', 'Convenience', 'Customer Service and Checkout Process', 'Employees',	'Food Departments and Quality',	'Food Selection and Variety', 'Shop_Store', 'Shop_Online', 'Delivery', 'Pickup_Curbside', 'Pickup_Store', 'Drive_Thru', 'Delivery_No_Contact', 'Delivery_Same_Day', 'Masks_Required', 'Great_Service', 'Wheelchair_Accessible', 'Quick_Visit', 'Organic_Food', 'Prepared_Food', 'Pay_Checks', 'Pay_Debit_Cards', 'Pay_NFC_Mobile', 'Pay_SNAP_EBT', 'Pay_Credit_Cards', 'Restroom', 'LGBTQ_Friendly', 'Family_Friendly', 'Longitude', 'Latitude', 'Address', 'PlusCode']
 
-stores[stores_table_columns[5:10]] = stores[stores_table_columns[5:10]].round(2)
-stores = stores.replace({np.nan: None})
-
-# Condense store types
-stores['Type'].replace({'Asian grocery store': 'Ethnic grocery store',
-                        'Butcher shop': 'Specialty food store',
-                        'Cafe': 'Ethnic grocery store',
-                        'Dollar store': 'Discount store',
-                        'Discount supermarket': 'Discount store',
-                        'Furniture store': 'Specialty food store',
-                        'Gas station': 'Convenience store',
-                        'Gourmet grocery store': 'Ethnic grocery store',
-                        'Health food store': 'Grocery store',
-                        'Lunch restaurant': 'Specialty food store',
-                        'Market': 'Convenience store',
-                        'Mexican grocery store': 'Ethnic grocery store',
-                        'Mexican restaurant': 'Ethnic grocery store',
-                        'Produce market': 'Specialty food store',
-                        'Store': 'Convenience store', # Weigel's Farm Stores only
-                        'Supermarket': 'Grocery store',
-                        'Warehouse club': 'Warehouse store'
-                        }, inplace=True)
-
-# Determine online options
-def get_online_stores(df):
-    stores_online = df[df['Delivery'] == 'Yes'][['Name', 'PlusCode', 'Delivery']].copy()
-    
-    for i_online, r_online in stores_online.iterrows():
-        if 'Publix' in r_online['Name']:
-            stores_online.loc[i_online, 'Name'] = 'Publix Super Market'
-        if 'Walmart' in r_online['Name']:
-            stores_online.loc[i_online, 'Name'] = 'Walmart'
-        if 'Kroger' in r_online['Name']:
-            stores_online.loc[i_online, 'Name'] = 'Kroger'
-        if 'Target' in r_online['Name']:
-            stores_online.loc[i_online, 'Name'] = 'Target'
-        if 'Food City' in r_online['Name']:
-            stores_online.loc[i_online, 'Name'] = 'Food City'
-        if 'BreadBox' in r_online['Name'] or 'Bread Box' in r_online['Name']:
-            stores_online.loc[i_online, 'Name'] = 'BreadBox'
-        if 'Ingles' in r_online['Name']:
-            stores_online.loc[i_online, 'Name'] = 'Ingles'
-            
-    #stores_online.drop_duplicates(['Name'], inplace=True, ignore_index=True)
-    
-    return stores_online
-
 stores_online = get_online_stores(stores)
 
-# Travel times between stops in people's trajectories and stores
-od = pd.read_csv('../Data/OD_v2.csv', index_col=0)
-od['free_time_start'] = pd.to_datetime(od['free_time_start'])#.dt.tz_localize('US/Eastern')
-od['free_time_end'] = pd.to_datetime(od['free_time_end'])#.dt.tz_localize('US/Eastern')
-
-# Individuals' information
-individuals = pd.read_csv('../Data/People_Synthetic_Data.csv')
-individuals.description = individuals.description.str.wrap(30)
-individuals.description = individuals.description.apply(lambda x: x.replace('\n', '<br>'))
-# Assume all virtual locations are available to a person from the start
-physical_opp = od[od['can_visit_spacetime']].groupby('person_id')['store_PlusCode'].nunique().reset_index().rename({'store_PlusCode':'PhysicalOpp'}, axis=1)
-individuals[individuals['digitallit'].isin(od['person_id'].unique())]
-
-## IDENTIFY HYBRID OPTIONS
-# OD rows where people can physically reach opportunities in space-time
-od_visit_spacetime = od['can_visit_spacetime']
-# OD rows for people who are digitally literate
-od_digitallit = od['person_id'].isin(individuals[individuals['digitallit'] == 'yes']['person_id'].values)
-# OD rows where the store has online shopping option
-od_shop_online = od['store_PlusCode'].isin(stores[stores['Shop_Online'] == True]['PlusCode'].values)
-
-# od[od_visit_spacetime & od_digitallit & od_shop_online].groupby('person_id')['store_PlusCode'].nunique().reset_index().rename({'store_PlusCode':'HybridOpp'}, axis=1)
-physical_opp['PhysicalOpp'] = physical_opp['PhysicalOpp'].fillna(0)
-
-individuals = pd.merge(individuals, physical_opp, left_on='person_id', right_on='person_id', how='left')
-individuals['VirtualOpp'] = [len(stores_online) if indiv_r['digitallit'] == 'yes' else 0 for indiv_i, indiv_r in individuals.iterrows()]   
-individuals['PhysicalOpp'] = individuals['PhysicalOpp'].replace(np.nan, 0)
-individuals['VirtualOpp'] = individuals['VirtualOpp'].replace(np.nan, 0)
-
-# hybrid_pluscode = od[od_visit_spacetime & od_digitallit & od_shop_online]['store_PlusCode'].drop_duplicates().values
-# physical_pluscode = od[~od['store_PlusCode'].isin(hybrid_pluscode) & od_visit_spacetime]['store_PlusCode'].drop_duplicates().values
-# virtual_pluscode = get_online_stores(stores[stores['PlusCode'].isin(od[~(od['store_PlusCode'].isin(hybrid_pluscode)) & ~(od['store_PlusCode'].isin(physical_pluscode))]['store_PlusCode'].drop_duplicates().values) & stores['Shop_Online']])['PlusCode'].values
-
-# physical_opp_total_all = len(physical_pluscode)
-# virtual_opp_total_all = len(virtual_pluscode)
-# hybrid_opp_total_all = len(hybrid_pluscode)
-
-# Main trajectory stops
-#traj_simple = pd.read_csv('./Data/Scenarios_Synthetic_Data.csv')
-
-# Main and travel trajectory stops (inclusive of every street)
-traj = pd.read_csv('../Data/Scenarios_Synthetic_Data_Trajectories.csv', index_col=0)
-traj.drop(columns=['time'], inplace=True)
-traj['person_id'] = traj['person_id'].astype(int)
-
-# Create TrajectoryCollection object
-collection = mpd.TrajectoryCollection(traj, 'person_id', t='datetime', x='longitude', y='latitude')
-
-# Trajectories
-trajectories = gpd.GeoDataFrame()
+# Columns of the stores table, indexed by PlusCode (unique per store) for lookups by store
+stores_table = stores.set_index('PlusCode', drop=False)[stores_table_columns]
 
-i = 0
-
-for trajectory in collection.trajectories:
-    # Calculate speed
-    trajectory.add_speed(overwrite=True)
-    
-    # Determine direction of movement
-    trajectory.add_direction(overwrite=True)
-    
-    # Parse time component (as datetime)
-    trajectory.df["daytime"] = pd.to_datetime(trajectory.df.index)
-    
-    # Add to container
-    trajectories = trajectories.append(trajectory.df)
-    
-    i+=1
-
-# Reorder the data based on timestamp
-trajectories = trajectories.sort_values(by="daytime").reset_index(drop=True)
-
-# Add longitude and latitude back into data frame
-trajectories["longitude"] = trajectories["geometry"].x
-trajectories["latitude"] = trajectories["geometry"].y
-# Sort trajectories by numerical order of person_id
-trajectories.sort_values(by=['person_id', 'daytime'], inplace=True)
+# People with a trajectory and store types, in the order of their traces in the 2-D and 3-D plots
+keys = trajectories['person_id'].unique()
+keys_stores = stores['Type'].unique()
 
-# Merge trajectories and individuals dataset so people's information can be visualized when hovered over in plots
-trajectories = pd.merge(trajectories, individuals, left_on='person_id', right_on='person_id')
+# Levels of detail of map geometries (see preprocess.LEVELS_OF_DETAIL) are keyed by the minimum mapbox zoom each level is shown at
+def level_of_detail(zoom):
+    '''
+    Retrieve the level of detail (the minimum zoom key of LEVELS_OF_DETAIL) to show at a given mapbox zoom
+    '''
+    return max(lod for lod in LEVELS_OF_DETAIL if lod <= (zoom or 0))
 
 # Local counties layer
 # Retrieve all points in the polygon of Knox County
@@ -180,10 +75,13 @@ with open('../Data/Local_Counties_v2.geojson') as f:
 pts = []
 
 # For each feature (e.g., county), retrieve all pairwise lon, lat of each point along the perimeter
+# The 3-D plot always shows the whole area, so the outline uses the coarsest level of detail
 # Store in pts list
 for feature in knox['features']:
-    pts.extend(feature['geometry']['coordinates'][0])    
-    pts.append([None, None]) # Mark the end of a polygon   
+    county = shape(feature['geometry']).simplify(LEVELS_OF_DETAIL[0], preserve_topology=True)
+    for polygon in getattr(county, 'geoms', [county]):
+        pts.extend(polygon.exterior.coords)
+        pts.append([None, None]) # Mark the end of a polygon   
 
 # Separate into two different lists
 knox_X, knox_Y = zip(*pts)
@@ -191,59 +89,8 @@ knox_Z = []
 # Psuedo z-column
 knox_Z += len(knox_X) * [dt(2022, 3, 10, 23, 59, 59)]
 
-knox_bg = gpd.read_file('../Data/Knox_County_BG_Census.shp')
-
-# Scale percentage values between 0 - 100
-knox_bg_columns=['Unemply',
-                 'NHSDplm',
-                 'Ag65Old',
-                 'Ag17Yng',
-                 'DisblHH',
-                 'SinglHH',
-                 'Minorty',
-                 'PrEngls',
-                 'MltUnts',
-                 'MobilHm',
-                 'Crowdng',
-                 'NoVehcl',
-                 'GropQrt',
-                 'SNAPBnf',
-                 'NoCmptr',
-                 'NIntrnt']
-
-for c in knox_bg_columns:
-    knox_bg[c] = knox_bg[c] * 100
-
-knox_bg.rename(columns={'TotlPpE': 'Population',
-                        'Incm_ME': 'Median Income $', 
-                        'Unemply': 'Unemployment %',
-                        'NHSDplm': 'No High School Diploma %',
-                        'Ag65Old': 'Age 65 or Older %',
-                        'Ag17Yng': 'Age 17 or Younger %',
-                        'DisblHH': 'Households with Disabled Person(s) %',
-                        'SinglHH': 'Households with Single Parent %',
-                        'Minorty': 'Non-White Population %',
-                        'PrEngls': 'Speaks English Less than well %',
-                        'MltUnts': 'Multi-Unit Housing %',
-                        'MobilHm': 'Mobile Home Housing %',
-                        'Crowdng': 'Crowded Housing %',
-                        'NoVehcl': 'Households without Vehicles %',
-                        'GropQrt': 'People Living in Group Quarters %',
-                        'SNAPBnf': 'People with SNAP Benefits %',
-                        'NoCmptr': 'People without Computers %',
-                        'NIntrnt': 'People without Internet %'},
-                        inplace=True
-              )
-
-
-
 # Retrieve columns of Census data that users can select to visualize in a choropleth map
 # Also add space-time prisms to 2-D Map
-prisms = gpd.read_file('../Data/Scenario_Flexible_Space_Time_Prisms.shp', index_col=0)
-prisms['free_time_start'] = pd.to_datetime(prisms['free_time_'])
-prisms['free_time_end'] = pd.to_datetime(prisms['free_tim_1'])
-
-
 knox_bg_cols = ['Select Block Group Choropleth Layer']
 for i_bg, col_bg in enumerate(knox_bg.columns.values):
     if col_bg not in ['GEOID', 'NAME', 'geometry']:
@@ -299,6 +146,9 @@ store_colors = {'Grocery store': '#4daf4a',
                 'Warehouse store': '#a65628'
                 }
 
+# Colors of the edges of each modality
+edge_colors = {'physical': '#5cb85c', 'virtual': '#0275d8', 'hybrid': 'yellow', 'self': 'grey'}
+
 def rgb_to_hex(rgb_list: list):
     '''
     Convert list of strings of RGB values into list of strings of HEX codes
@@ -318,7 +168,151 @@ def rgb_to_hex(rgb_list: list):
 
 colors_hex = rgb_to_hex(colors)
 
-def create_2d_map(choropleth_z, individuals_df, trajectories_df, stores_df, prisms_df): 
+# Serialized GeoJSON of choropleth layers, keyed by layer, level of detail, and the set of features shown; least recently used entries are evicted first
+GEOJSON_CACHE_SIZE = 32
+geojson_cache = OrderedDict()
+
+def serialize_layer_features(layer_lods):
+    '''
+    Serialize the geometry of every feature of a layer once per level of detail, keyed by the index value used as the feature id
+    
+    Geometries are simplified by preprocess.py (see preprocess.layer_lods) so that neighboring polygons keep sharing their boundaries
+    '''
+    return {lod: dict(zip(gdf_lod.index, json.loads(gdf_lod[['geometry']].to_json())['features']))
+            for lod, gdf_lod in layer_lods.groupby('lod')}
+
+def layer_geojson(layer, ids, lod):
+    '''
+    Retrieve the final GeoJSON FeatureCollection of a choropleth layer at a level of detail restricted to the features with the given ids
+    
+    Features are assembled from the geometries serialized at startup, and the resulting collection is cached so that
+    unchanged layers (e.g., when only the table page or the attribute column changes) are neither re-encoded nor rebuilt
+    '''
+    key = (layer, lod, frozenset(ids))
+    if key in geojson_cache:
+        geojson_cache.move_to_end(key)
+        return geojson_cache[key]
+    
+    features = layer_features[layer][lod]
+    geojson = {'type': 'FeatureCollection', 'features': [features[i] for i in ids]}
+    
+    geojson_cache[key] = geojson
+    if len(geojson_cache) > GEOJSON_CACHE_SIZE:
+        geojson_cache.popitem(last=False)
+    return geojson
+
+# Maximum number of trajectory points drawn in each of the 2-D and 3-D plots; beyond it, trajectories are decimated to their most significant points
+TRAJECTORY_POINT_BUDGET = 5000
+
+def decimate_trajectories(trajectories_df, budget=TRAJECTORY_POINT_BUDGET):
+    '''
+    Keep the (at most budget) most significant trajectory points, in their original order
+    
+    Significance is precomputed Douglas-Peucker in space-time (see preprocess.add_trajectory_significance); stop points,
+    the point of every trajectory nearest each store near it, and the ends of every trajectory are always kept, even beyond the budget
+    '''
+    if len(trajectories_df) <= budget:
+        return trajectories_df
+    significance = trajectories_df['significance'].to_numpy()
+    threshold = np.partition(significance, len(significance) - budget)[len(significance) - budget]
+    return trajectories_df[significance >= threshold]
+
+
+def is_block_group_layer(choropleth_z):
+    '''
+    Whether a layer of the 2-D map dropdown is an attribute column of the block groups
+    '''
+    return choropleth_z not in ('Select Block Group Choropleth Layer', 'Space Time Prisms')
+
+def map_2d_choropleth(choropleth_z, prisms_df, lod, region=None, geometry=True):
+    '''
+    Retrieve the properties of the choropleth trace of the 2-D map, restricted to the features intersecting a region (None for all)
+    
+    Only the z values are taken from the data-frames; the geometries come from the GeoJSON cache.
+    With geometry=False the geojson and locations are left out, for a block group layer replacing another at the same level of detail and region
+    '''
+    if choropleth_z == 'Select Block Group Choropleth Layer':
+        return {'geojson': None, 'locations': [], 'z': [], 'name': choropleth_z, 'visible': False}
+    if choropleth_z == 'Space Time Prisms':
+        if region is not None:
+            prisms_df = prisms_df[prisms_df.index.isin(prisms.index[query_spatial_index(prisms_spatial_index, region)])]
+        return {'geojson': layer_geojson('Space Time Prisms', prisms_df.index, lod),
+                'locations': prisms_df.index.tolist(),
+                'z': prisms_df['StoreOpps'].tolist(),
+                'name': choropleth_z,
+                'visible': True}
+    knox_bg_region = knox_bg if region is None else knox_bg.iloc[query_spatial_index(knox_bg_spatial_index, region)]
+    choropleth = {'z': knox_bg_region[choropleth_z].tolist(), 'name': choropleth_z, 'visible': True}
+    if geometry:
+        choropleth.update({'geojson': layer_geojson('Block Groups', knox_bg_region.index, lod), 'locations': knox_bg_region.index.tolist()})
+    return choropleth
+
+def map_2d_trajectories(individuals_df, trajectories_df):
+    '''
+    Retrieve the properties of the trajectory traces of the 2-D map, one per person in keys
+    
+    People filtered out are hidden (and so left out of the legend) rather than removed so that every trace keeps its position in the figure
+    '''
+    # Add activated trajectories in given timerange onto map, decimated to the point budget
+    trajectories_shown = decimate_trajectories(trajectories_df[trajectories_df['person_id'].isin(individuals_df['person_id'])])
+    # Split the points of every person in one pass rather than scanning the data-frame once per person
+    person_points = {person: points for person, points in trajectories_shown.groupby('person_id', sort=False)[['longitude', 'latitude']]}
+    no_points = trajectories_shown.iloc[:0]
+    
+    person_ids = set(individuals_df['person_id'])
+    traces = []
+    for person in keys:
+        points = person_points.get(person, no_points)
+        traces.append({'lon': points['longitude'].tolist(),
+                       'lat': points['latitude'].tolist(),
+                       'visible': person in person_ids})
+    return traces
+
+def stores_in_region(stores_df, region):
+    '''
+    Restrict a data-frame of stores to those within a region of the 2-D map (None for all)
+    '''
+    if region is None:
+        return stores_df
+    return stores_df[stores_df['PlusCode'].isin(stores['PlusCode'].iloc[query_spatial_index(stores_spatial_index, region)])]
+
+def map_stores(stores_df, z=None):
+    '''
+    Retrieve the properties of the store traces of the 2-D map (or, given a pseudo z-value, of the 3-D plot), one per store type in keys_stores
+    
+    Store types without any store shown are hidden rather than removed so that every trace keeps its position in the figure
+    '''
+    traces = []
+    for store_type in keys_stores:
+        stores_df_type = stores_df[stores_df['Type'] == store_type]
+        text = '<br><b> Name:</b> ' + stores_df_type.Name + '<br><b> Address:</b> ' + stores_df_type.Address + '<br><b> Rating:</b> ' + stores_df_type.Rating.astype(str) + '<br><b> Price:</b> ' + stores_df_type.Price.astype(str) + '<br><b> Type:</b> ' + stores_df_type.Type
+        if z is None:
+            trace = {'lon': stores_df_type['Longitude'].tolist(), 'lat': stores_df_type['Latitude'].tolist()}
+        else:
+            trace = {'x': stores_df_type['Longitude'].tolist(), 'y': stores_df_type['Latitude'].tolist(), 'z': [z] * len(stores_df_type)}
+        trace['text'] = text.tolist()
+        trace['visible'] = len(stores_df_type) > 0
+        traces.append(trace)
+    return traces
+
+def patch_traces(patched_figure, first_trace, traces):
+    '''
+    Set the given properties of consecutive traces of a figure, starting at trace index first_trace, in a Patch
+    '''
+    for offset, trace in enumerate(traces):
+        for prop, value in trace.items():
+            patched_figure['data'][first_trace + offset][prop] = value
+    return patched_figure
+
+# Positions of the traces of the 2-D map: a placeholder, the choropleth, one trajectory per person, then one per store type
+MAP_2D_CHOROPLETH_TRACE = 1
+MAP_2D_TRAJECTORY_TRACE = 2
+MAP_2D_STORE_TRACE = MAP_2D_TRAJECTORY_TRACE + len(keys)
+# Center and zoom the 2-D map is first shown at
+MAP_2D_CENTER = {'lat': 35.99, 'lon': -83.9650}
+MAP_2D_ZOOM = 9
+
+def create_2d_map(choropleth_z, individuals_df, trajectories_df, stores_df, prisms_df, lod=min(LEVELS_OF_DETAIL), region=None): 
     ## 2-D MAP
     
     # Instantiate Map object built off of Plotly.graph_objects
@@ -330,68 +324,47 @@ def create_2d_map(choropleth_z, individuals_df, trajectories_df, stores_df, pris
         mapbox_zoom=8,
         #basemap='open-street-map'
     )
-    # Add Choropleth layer
-    if choropleth_z != 'Select Block Group Choropleth Layer':
-        
-        choro_gj = None
-        choro_locs = None
-        choro_z = None
-        
-        if choropleth_z == 'Space Time Prisms':
-            choro_gj = json.loads(prisms_df.drop(['free_time_start', 'free_time_end'], axis=1).to_json())
-            choro_locs = prisms_df.index
-            choro_z = prisms_df['StoreOpps']
-        else:
-            choro_gj = json.loads(knox_bg.to_json())
-            choro_locs = knox_bg.index
-            choro_z = knox_bg[choropleth_z]
-            
-        map_2.add_trace(go.Choroplethmapbox(
-                        geojson=choro_gj,
-                        locations=choro_locs,
-                        z=choro_z,
-                        #customdata=
-                        #colorbar_title=map_2d_dropdown_value,
-                        colorbar_orientation='h',
-                        colorbar_len=0.5,
-                        colorbar_tickfont_color='black',
-                        colorbar_thickness=10,
-                        colorbar_tickfont_family='Roboto',
-                        colorbar_y = 0,
-                        colorbar_x = 0.3,
-                        name=choropleth_z,
-                        marker_opacity=0.5
-                        #hovertemplate = '<br><b> ST-Prism:</b><extra></extra>%{text}',
-        ))
-        #map_2.set_layer_opacity(choropleth_z, opacity = 0.5)
+    # Add Choropleth layer; it is always present (hidden when no layer is selected) so that it can be patched in place
+    map_2.add_trace(go.Choroplethmapbox(
+                    **map_2d_choropleth(choropleth_z, prisms_df, lod, region),
+                    #customdata=
+                    #colorbar_title=map_2d_dropdown_value,
+                    colorbar_orientation='h',
+                    colorbar_len=0.5,
+                    colorbar_tickfont_color='black',
+                    colorbar_thickness=10,
+                    colorbar_tickfont_family='Roboto',
+                    colorbar_y = 0,
+                    colorbar_x = 0.3,
+                    marker_opacity=0.5
+                    #hovertemplate = '<br><b> ST-Prism:</b><extra></extra>%{text}',
+    ))
+    #map_2.set_layer_opacity(choropleth_z, opacity = 0.5)
         
     # Set layout parameters
+    # A constant uirevision keeps the user's zoom and pan when the figure is patched
     map_2.update_layout(
         mapbox_style = 'open-street-map',
         font=dict(size=12),
-        mapbox_zoom = 9,
-        mapbox_center = {'lat':35.99, 'lon':-83.9650},
+        mapbox_zoom = MAP_2D_ZOOM,
+        mapbox_center = MAP_2D_CENTER,
+        uirevision = 'map-2d',
     )       
     
-    # Add activated trajectories in given timerange onto map
-    for person in individuals_df['person_id'].unique():
+    for person, trace in zip(keys, map_2d_trajectories(individuals_df, trajectories_df)):
         map_2.add_trace(go.Scattermapbox(
             mode = 'markers+lines',
-            lon = trajectories[trajectories['person_id'] == person]['longitude'],
-            lat = trajectories[trajectories['person_id'] == person]['latitude'],
             marker = {'size': 4, 'color': indiv_colors[person]},
-            name = 'Person ' + str(person)
+            name = 'Person ' + str(person),
+            **trace
         ))
     
     # Default weight is 1000 and so setting the weight of trajectories to be larger than that means future undefined traces (e.g., stores) will be brought above
     map_2.update_traces(legendrank=1001, selector=dict(type='scattermapbox'))
     
     # Create graph objects figure of a scatter mapbox of stores
-    for store_type in stores_df['Type'].unique():
-        stores_df_type = stores_df[stores_df['Type'] == store_type]
+    for store_type, trace in zip(keys_stores, map_stores(stores_in_region(stores_df, region))):
         map_2.add_trace(go.Scattermapbox(
-                lon = stores_df_type.Longitude, 
-                lat = stores_df_type.Latitude,
                 mode = 'markers',
                 marker_color = store_colors[store_type],
                 marker_size = 20,
@@ -400,7 +373,7 @@ def create_2d_map(choropleth_z, individuals_df, trajectories_df, stores_df, pris
                 #size_max = 60,
                 #zoom = 8,
                 hovertemplate = '<br><b> Food Store:</b><extra></extra>%{text}',
-                text='<br><b> Name:</b> ' + stores_df_type.Name + '<br><b> Address:</b> ' + stores_df_type.Address + '<br><b> Rating:</b> ' + stores_df_type.Rating.astype(str) + '<br><b> Price:</b> ' + stores_df_type.Price.astype(str) + '<br><b> Type:</b> ' + stores_df_type.Type,
+                **trace
            ))
     
     # Add graph objects as traces to map
@@ -422,9 +395,22 @@ def create_2d_map(choropleth_z, individuals_df, trajectories_df, stores_df, pris
     return map_2
 
 
+# Positions of the traces of the 3-D plot: one trajectory per person, the county boundaries, then one per store type
+MAP_3D_STORE_TRACE = len(keys) + 1
+# Psuedo z-value (time) of the stores in the 3-D plot
+MAP_3D_STORES_Z = dt(2022, 3, 10, 23, 59, 59)
+
+def map_3d_visibility(individuals_df_filter):
+    '''
+    Retrieve the visibility of the trajectory trace of every person in keys in the 3-D plot; people filtered out are only shown in the legend
+    '''
+    person_ids = set(individuals_df_filter['person_id'])
+    return [{'visible': True if person in person_ids else 'legendonly'} for person in keys]
+
 def create_3d_map(trajectories_df, stores_df, individuals_df_filter, individuals_df_unfilter):
     ## 3-D Plot
-    map_3 = px.line_3d(trajectories_df,
+    # Only the most significant points within the point budget are drawn
+    map_3 = px.line_3d(decimate_trajectories(trajectories_df),
                        x="longitude", y="latitude", z="daytime",
                        color='person_id', color_discrete_map=indiv_colors,                 
                        custom_data=['person_id',
@@ -490,21 +476,14 @@ def create_3d_map(trajectories_df, stores_df, individuals_df_filter, individuals
                       line_width=1.5,
                       showlegend=False) 
     
-    # Create psuedo z-field for stores
-    stores_Z = list(len(stores_df) * [dt(2022, 3, 10, 23, 59, 59)])
-    
-    # Add stores to plot
-    for store_type in stores_df['Type'].unique():
-        stores_df_type = stores_df[stores_df.Type == store_type]
+    # Add stores to plot at a psuedo z-value, one trace per store type
+    for store_type, trace in zip(keys_stores, map_stores(stores_df, z=MAP_3D_STORES_Z)):
         map_3.add_trace(go.Scatter3d(
-            x=stores_df_type['Longitude'],
-            y=stores_df_type['Latitude'],
-            z=stores_Z[0:len(stores_df_type)],
             mode='markers',
             marker_color=store_colors[store_type],
             hovertemplate = '<br><b> Food Store:</b><extra></extra>%{text}',
-            text='<br><b> Name:</b> ' + stores_df_type.Name + '<br><b> Address:</b> ' + stores_df_type.Address + '<br><b> Rating:</b> ' + stores_df_type.Rating.astype(str) + '<br><b> Price:</b> ' + stores_df_type.Price.astype(str) + '<br><b> Type:</b> ' + stores_df_type.Type,
-            showlegend = False
+            showlegend = False,
+            **trace
         ))
     # map_3.add_scatter3d(
     #     x = stores_df['Longitude'],
@@ -518,7 +497,9 @@ def create_3d_map(trajectories_df, stores_df, individuals_df_filter, individuals
     # )
     
     # Update layout
+    # A constant uirevision keeps the user's camera when the figure is patched
     map_3.update_layout(legend_traceorder='normal',
+                      uirevision='map-3d',
                       font=dict(family="Roboto"),
                       template = 'simple_white',
                       margin=dict(l=4, r=5, t=0, b=4),
@@ -529,97 +510,510 @@ def create_3d_map(trajectories_df, stores_df, individuals_df_filter, individuals
 
     # Synchronize table and 3d plot
     # Users can both click/unclick individual legend traces AND query the table
-    for idx_trace, r_trace in enumerate(map_3.data):
-        if (idx_trace+1 not in individuals_df_filter['person_id'].unique()) & (idx_trace < len(individuals_df_unfilter['person_id'].unique())):
-            r_trace.visible = 'legendonly'
+    for r_trace, trace in zip(map_3.data, map_3d_visibility(individuals_df_filter)):
+        r_trace.visible = trace['visible']
             
     return map_3
 
 
-# https://medium.com/plotly/introducing-dash-cytoscape-ce96cac824e4
-#https://github.com/plotly/dash-cytoscape/blob/master/usage-stylesheet.py
-def network_data(od_df, individuals_df, stores_df, stores_online_df):
+def _interval_values(values, is_datetime):
+    '''
+    Convert window bounds into plain numbers (int64 nanoseconds for datetimes) that can be sorted and searched, along with a mask of missing bounds
+    '''
+    if is_datetime:
+        values = pd.to_datetime(pd.Series(values)).to_numpy(dtype='datetime64[ns]')
+        return values.view('i8'), np.isnat(values)
+    values = np.asarray(values, dtype=float)
+    return values, np.isnan(values)
+
+
+def build_interval_index(starts, ends):
+    '''
+    Build a sorted interval index over [start, end] windows, e.g., free-time windows or trajectory timestamps (start == end)
+    
+    Windows are split into buckets by their length (powers of two) and sorted by start within each bucket.
+    A window of a bucket starting within [start, end - longest window of the bucket] is always contained in [start, end],
+    so only the windows starting within the last (bounded) stretch of each bucket need their end checked.
+    Windows with a missing start or end are never returned.
+    '''
+    is_datetime = np.asarray(starts).dtype.kind == 'M'
+    starts, starts_missing = _interval_values(starts, is_datetime)
+    ends, ends_missing = _interval_values(ends, is_datetime)
+    valid = np.flatnonzero(~(starts_missing | ends_missing))
+    
+    lengths = np.maximum(ends[valid] - starts[valid], 0).astype(float)
+    length_buckets = np.ceil(np.log2(lengths + 1)).astype(int)
+    
+    buckets = []
+    for bucket in np.unique(length_buckets):
+        positions = valid[length_buckets == bucket]
+        positions = positions[np.argsort(starts[positions], kind='stable')]
+        buckets.append({'positions': positions,
+                        'starts': starts[positions],
+                        'ends': ends[positions],
+                        'max_length': (ends[positions] - starts[positions]).max()})
+    
+    return {'is_datetime': is_datetime, 'buckets': buckets}
+
+
+def query_interval_index(index, start=None, end=None):
+    '''
+    Retrieve the (sorted) positions of all windows contained in [start, end] in logarithmic time plus output size
+    
+    A start or end of None leaves that side of the range open.
+    '''
+    # Missing bounds (e.g., an unparseable date) match no window
+    if (start is not None and pd.isna(start)) or (end is not None and pd.isna(end)):
+        return np.array([], dtype=int)
+    if start is not None:
+        start = _interval_values([start], index['is_datetime'])[0][0]
+    if end is not None:
+        end = _interval_values([end], index['is_datetime'])[0][0]
+    
+    positions = []
+    for bucket in index['buckets']:
+        # Condition 1: the window starts at or after the start of the range
+        lo = 0 if start is None else np.searchsorted(bucket['starts'], start, side='left')
+        if end is None:
+            positions.append(bucket['positions'][lo:])
+            continue
+        # Condition 2: the window ends at or before the end of the range, which a window starting after the end of the range never does
+        hi = np.searchsorted(bucket['starts'], end, side='right')
+        # Windows starting early enough are guaranteed to satisfy condition 2; only the remaining ones are checked
+        safe = min(max(np.searchsorted(bucket['starts'], end - bucket['max_length'], side='right'), lo), hi)
+        positions.append(bucket['positions'][lo:safe])
+        positions.append(bucket['positions'][safe:hi][bucket['ends'][safe:hi] <= end])
+    
+    if not positions:
+        return np.array([], dtype=int)
+    return np.sort(np.concatenate(positions))
+
+
+
+def build_spatial_index(bounds, node_capacity=16):
+    '''
+    Build a static R-tree over bounding boxes (min x, min y, max x, max y), e.g., of store points (min == max) or polygons
+    
+    Entries are packed node_capacity at a time into leaves with Sort-Tile-Recursive packing: they are split into vertical slices
+    by the x of their centers and sorted by the y of their centers within each slice. Consecutive nodes are then packed the same number
+    at a time into the level above until a single root remains. Entries with missing bounds (e.g., empty geometries) are never returned.
+    '''
+    bounds = np.asarray(bounds, dtype=float).reshape(-1, 4)
+    valid = np.flatnonzero(~np.isnan(bounds).any(axis=1))
+    
+    centers_x = (bounds[valid, 0] + bounds[valid, 2]) / 2
+    centers_y = (bounds[valid, 1] + bounds[valid, 3]) / 2
+    n_slices = max(int(np.ceil(np.sqrt(np.ceil(len(valid) / node_capacity)))), 1)
+    slices = np.empty(len(valid), dtype=int)
+    slices[np.argsort(centers_x, kind='stable')] = np.arange(len(valid)) // (n_slices * node_capacity)
+    order = valid[np.lexsort((centers_y, slices))]
+    
+    # Bounds of the entries (level 0) and of the nodes of every level above; node i covers children [i * node_capacity, (i + 1) * node_capacity)
+    levels = [bounds[order]]
+    while len(levels[-1]) > 1:
+        children = levels[-1]
+        starts = np.arange(0, len(children), node_capacity)
+        levels.append(np.column_stack([np.fmin.reduceat(children[:, 0], starts),
+                                       np.fmin.reduceat(children[:, 1], starts),
+                                       np.fmax.reduceat(children[:, 2], starts),
+                                       np.fmax.reduceat(children[:, 3], starts)]))
+    
+    return {'order': order, 'levels': levels, 'node_capacity': node_capacity}
 
-    od_shop_mode = []
 
-    # Only retain stores that can be visited and participated in given an individual's space-time constraints
-    od_df_st = od_df[od_df['can_visit_spacetime']]    
-    # Remove duplicate person - store entries
-    od_condensed = od_df_st[['person_id', 'store_PlusCode', 'can_visit_spacetime']].drop_duplicates(['person_id', 'store_PlusCode'])
+def query_spatial_index(index, box):
+    '''
+    Retrieve the (sorted) positions of all entries whose bounding box intersects a box (min x, min y, max x, max y)
+    
+    The tree is descended one level at a time, keeping only the nodes intersecting the box at every level.
+    '''
+    min_x, min_y, max_x, max_y = box
+    levels, node_capacity = index['levels'], index['node_capacity']
+    nodes = np.arange(len(levels[-1]))
+    for depth in range(len(levels) - 1, -1, -1):
+        node_bounds = levels[depth][nodes]
+        nodes = nodes[(node_bounds[:, 0] <= max_x) & (node_bounds[:, 2] >= min_x) & (node_bounds[:, 1] <= max_y) & (node_bounds[:, 3] >= min_y)]
+        if depth:
+            nodes = (nodes[:, None] * node_capacity + np.arange(node_capacity)).ravel()
+            nodes = nodes[nodes < len(levels[depth - 1])]
+    return np.sort(index['order'][nodes])
+
+
+def nearest_spatial_index(index, x, y, x_scale=1):
+    '''
+    Retrieve the position of the entry nearest a point by the distance to its bounding box (exact for points), or None if the index is empty
+    
+    Nodes are visited best-first by their distance to the point, which never exceeds that of any entry they cover.
+    x distances are multiplied by x_scale, e.g., the cosine of the latitude so that degrees of longitude and latitude are comparable.
+    '''
+    levels, node_capacity = index['levels'], index['node_capacity']
+    
+    def box_distances(node_bounds):
+        dx = np.maximum.reduce([node_bounds[:, 0] - x, np.zeros(len(node_bounds)), x - node_bounds[:, 2]]) * x_scale
+        dy = np.maximum.reduce([node_bounds[:, 1] - y, np.zeros(len(node_bounds)), y - node_bounds[:, 3]])
+        return np.hypot(dx, dy)
+    
+    depth = len(levels) - 1
+    heap = [(distance, depth, node) for node, distance in enumerate(box_distances(levels[depth]))]
+    heapq.heapify(heap)
+    while heap:
+        distance, depth, node = heapq.heappop(heap)
+        if depth == 0:
+            return index['order'][node]
+        children = np.arange(node * node_capacity, min((node + 1) * node_capacity, len(levels[depth - 1])))
+        for child, child_distance in zip(children, box_distances(levels[depth - 1][children])):
+            heapq.heappush(heap, (child_distance, depth - 1, child))
+    return None
+
+
+def containing_features(gdf, index, lon, lat):
+    '''
+    Retrieve the positions of the features of a layer whose geometry contains a point; only those whose bounding box does are tested
+    '''
+    point = Point(lon, lat)
+    return [position for position in query_spatial_index(index, (lon, lat, lon, lat)) if gdf.geometry.iloc[position].contains(point)]
+
+
+# Share of the viewport's width and height added on every side of the region of the 2-D map sent to the browser, so that small pans need no update
+VIEWPORT_MARGIN = 0.5
+
+def viewport_around(lon, lat, zoom):
+    '''
+    Approximate the bounds (min lon, min lat, max lon, max lat) of the 2-D map viewport centered on a point at a mapbox zoom
+    
+    The viewport is assumed to be at most 1024 by 512 pixels (512-pixel mapbox tiles span 360 degrees of longitude at zoom 0)
+    '''
+    half_lon = 360 / 2 ** zoom
+    half_lat = half_lon / 2 * np.cos(np.radians(lat))
+    return [lon - half_lon, lat - half_lat, lon + half_lon, lat + half_lat]
+
+def mapbox_viewport(relayout_data):
+    '''
+    Retrieve the bounds (min lon, min lat, max lon, max lat) of the mapbox viewport reported in the relayoutData of a map, or None if it is not reported
+    '''
+    relayout_data = relayout_data or {}
+    coordinates = (relayout_data.get('mapbox._derived') or {}).get('coordinates')
+    if coordinates:
+        lons, lats = zip(*coordinates)
+        return [min(lons), min(lats), max(lons), max(lats)]
+    center, zoom = relayout_data.get('mapbox.center'), relayout_data.get('mapbox.zoom')
+    if center and zoom is not None:
+        return viewport_around(center['lon'], center['lat'], zoom)
+    return None
+
+def viewport_region(viewport):
+    '''
+    Retrieve the region of the 2-D map sent to the browser for a viewport: the viewport grown by VIEWPORT_MARGIN on every side
+    '''
+    min_lon, min_lat, max_lon, max_lat = viewport
+    margin_lon, margin_lat = (max_lon - min_lon) * VIEWPORT_MARGIN, (max_lat - min_lat) * VIEWPORT_MARGIN
+    return [min_lon - margin_lon, min_lat - margin_lat, max_lon + margin_lon, max_lat + margin_lat]
+
+def region_contains(region, viewport):
+    '''
+    Whether a viewport lies within a region of the 2-D map; a region of None (everything sent) contains every viewport
+    '''
+    if region is None:
+        return True
+    return region[0] <= viewport[0] and region[1] <= viewport[1] and viewport[2] <= region[2] and viewport[3] <= region[3]
+
+# Level of detail and region of the 2-D map at its initial center and zoom, so that only the features around it are sent until it is zoomed or panned
+MAP_2D_LOD = level_of_detail(MAP_2D_ZOOM)
+MAP_2D_REGION = viewport_region(viewport_around(MAP_2D_CENTER['lon'], MAP_2D_CENTER['lat'], MAP_2D_ZOOM))
+
+
+# Number of set bits in every possible byte, used to count opportunities directly from packed bitsets
+POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1)
+
+def build_access_index(od_df, individuals_df, stores_df, what_if_minutes=0):
+    '''
+    Build a compact person x store x free-time window index of space-time reachability
+    
+    Every free-time window of a person is stored as a packed bitset over all stores (one bit per store) marking the stores that person can visit within that window.
+    Filters on people, stores, and dates then become mask intersections over these bitsets rather than scans of the OD data-frame.
+    what_if_minutes is how far beyond every window the OD records trips (see preprocess.od_what_if_minutes), the most free time can be extended by.
+    '''
+    person_ids = np.sort(individuals_df['person_id'].unique())
+    store_codes = pd.Index(stores_df['PlusCode'].unique())
+    
+    window_keys = ['person_id', 'free_time_start', 'free_time_end']
+    od_windows = od_df[od_df['person_id'].isin(person_ids) & od_df['store_PlusCode'].isin(store_codes)].dropna(subset=window_keys)
+    
+    # Number each (person, free_time_start, free_time_end) window in sorted order so windows of the same person are contiguous
+    windows = od_windows[window_keys].drop_duplicates().sort_values(window_keys)
+    window_ids = pd.MultiIndex.from_frame(windows).get_indexer(pd.MultiIndex.from_frame(od_windows[window_keys]))
+    store_ids = store_codes.get_indexer(od_windows['store_PlusCode'])
+    visit = od_windows['can_visit_spacetime'].to_numpy(dtype=bool)
+    
+    # Bits are set directly in the packed bitsets (bit 7 - store % 8 of byte store // 8, as np.packbits orders them), so no unpacked matrix is ever allocated
+    window_bits = np.zeros((len(windows), -(-len(store_codes) // 8)), dtype=np.uint8)
+    np.bitwise_or.at(window_bits, (window_ids[visit], store_ids[visit] >> 3), (0x80 >> (store_ids[visit] & 7)).astype(np.uint8))
+    
+    # Minutes to spare (negative) of the window x store trips that cannot be visited but were recorded by od_builder.py (up to its what-if
+    # horizon beyond every window), used to extend free time in what-if scenarios; kept in compressed sparse rows (one row per window)
+    window_spare = None
+    if 'spare_time' in od_windows:
+        spare_time = od_windows['spare_time'].to_numpy(dtype=float)
+        near = np.flatnonzero(~visit & ~np.isnan(spare_time))
+        near = near[np.lexsort((store_ids[near], window_ids[near]))]
+        window_spare = {'indptr': np.r_[0, np.cumsum(np.bincount(window_ids[near], minlength=len(windows)))],
+                        'stores': store_ids[near].astype(np.int32),
+                        'minutes': spare_time[near].astype(np.float32)}
+    
+    digitallit = individuals_df.drop_duplicates('person_id').set_index('person_id')['digitallit'].reindex(person_ids) == 'yes'
+    shop_online = stores_df.drop_duplicates('PlusCode').set_index('PlusCode')['Shop_Online'].reindex(store_codes) == True
+    
+    return {'person_ids': person_ids,
+            'store_codes': store_codes,
+            'window_person': np.searchsorted(person_ids, windows['person_id'].to_numpy()),
+            'window_start': windows['free_time_start'].to_numpy(),
+            'window_end': windows['free_time_end'].to_numpy(),
+            'window_bits': window_bits,
+            'window_spare': window_spare,
+            'what_if_minutes': what_if_minutes,
+            'window_interval_index': build_interval_index(windows['free_time_start'], windows['free_time_end']),
+            'digitallit': digitallit.to_numpy(),
+            'shop_online_bits': np.packbits(shop_online.to_numpy())}
+
+
+def store_bits(index, store_codes):
+    '''
+    Pack a list of store PlusCodes into a bitset aligned with the stores of the access index
+    '''
+    return np.packbits(index['store_codes'].isin(store_codes))
+
+
+def query_access_index(index, start, end, person_ids):
+    '''
+    Retrieve the packed person x store bitsets of stores the given people can visit within free-time windows contained in [start, end]
+    
+    A start or end of None leaves that side of the time range open.
+    '''
+    windows = query_interval_index(index['window_interval_index'], start, end)
+    windows = windows[np.isin(index['window_person'][windows], np.flatnonzero(np.isin(index['person_ids'], person_ids)))]
+    return window_reach(index, windows, index['window_bits'][windows])
+
+
+def extended_window_bits(index, windows, minutes):
+    '''
+    Retrieve the packed bitsets of the given windows extended by some minutes: every trip with as many minutes to spare as the extension lacks fits
+    '''
+    spare = index['window_spare']
+    starts = spare['indptr'][windows]
+    counts = spare['indptr'][windows + 1] - starts
+    # Positions of the sparse entries of the given windows, and the position of their window among them
+    rows = np.repeat(np.arange(len(windows)), counts)
+    entries = np.arange(counts.sum()) + np.repeat(starts - (np.cumsum(counts) - counts), counts)
+    fits = spare['minutes'][entries] >= -minutes
+    rows, store_ids = rows[fits], spare['stores'][entries[fits]]
+    
+    extended_bits = index['window_bits'][windows].copy()
+    np.bitwise_or.at(extended_bits, (rows, store_ids >> 3), (128 >> (store_ids & 7)).astype(np.uint8))
+    return extended_bits
+
+
+def window_reach(index, windows, window_bits):
+    '''
+    Retrieve the packed person x store bitsets of the union of the given (sorted) windows' bitsets of every person
+    '''
+    reach = np.zeros((len(index['person_ids']), index['window_bits'].shape[1]), dtype=np.uint8)
+    if len(windows):
+        # Windows are sorted by person, so the union of each person's windows is a single reduceat over contiguous runs
+        window_person = index['window_person'][windows]
+        run_starts = np.flatnonzero(np.r_[True, window_person[1:] != window_person[:-1]])
+        reach[window_person[run_starts]] = np.bitwise_or.reduceat(window_bits, run_starts, axis=0)
+    return reach
+
+
+def reachable_stores(index, reach):
+    '''
+    Retrieve the PlusCodes of all stores reachable by anyone in the packed person x store bitsets
+    '''
+    any_reach = np.unpackbits(np.bitwise_or.reduce(reach, axis=0), count=len(index['store_codes'])).astype(bool)
+    return index['store_codes'][any_reach]
+
+
+def access_index_modalities(index, reach, person_ids, store_codes, online_store_codes):
+    '''
+    Classify every accessible (person, store) pair as a physical, virtual, or hybrid opportunity with bitset intersections
+    
+    Returns the pairs with their 'Shop_Mode', the per-person [physical, virtual, hybrid] counts, and the store PlusCodes accessible by each modality
+    '''
+    n_stores = len(index['store_codes'])
+    persons = np.isin(index['person_ids'], person_ids)
+    digitallit = (persons & index['digitallit'])[:, None]
+    
+    # Only retain stores shown in the stores table
+    reach = reach & store_bits(index, store_codes)
+    
+    # A physically accessible store is a hybrid opportunity if the person is digitally literate and the store has online services; otherwise, it is a physical opportunity
+    # Every digitally literate person can also reach every online store they cannot already reach in person
+    hybrid = np.where(digitallit, reach & index['shop_online_bits'], 0).astype(np.uint8)
+    physical = reach & ~hybrid
+    virtual = np.where(digitallit, store_bits(index, online_store_codes) & ~reach, 0).astype(np.uint8)
     
     # Dictionary of individuals and accessible physical, virtual, and hybrid options
-    pvh_opps = {i:[0,0,0] for i in range(1,53)}
-    
-    stores_physical_pluscode = []
-    stores_virtual_pluscode = []
-    stores_hybrid_pluscode = []
-    
-    stores_modality = []
-    
-    # For every OD pair
-    for i, r in od_condensed.iterrows():
-        # If the person is digitally literate
-        if (individuals.loc[r['person_id'] - 1, 'digitallit'] == 'yes'):
-            # If the store has online services
-            if (stores_df[stores_df['Shop_Online']]['PlusCode'] == r['store_PlusCode']).any():
-                # The person can shop either in person or online, so we'll assign a hybrid mode
-                od_shop_mode.append('Hybrid')
-                
-                # Add to hybrid counter for that person
-                pvh_opps[r['person_id']][2] += 1
-                
-                # Add the Store PlusCode to a list which we'll use to track total number of accessible opportunities by shopping modality
-                if (r['store_PlusCode'] not in stores_hybrid_pluscode): 
-                    stores_hybrid_pluscode.append(r['store_PlusCode'])
-                    if (r['store_PlusCode'] in stores_physical_pluscode):
-                        stores_physical_pluscode.remove(r['store_PlusCode'])
-                    
-            # Otherwise, that person can only access in-person
-            else:
-                if (r['store_PlusCode'] not in stores_hybrid_pluscode) & (r['store_PlusCode'] not in stores_physical_pluscode):
-                    stores_physical_pluscode.append(r['store_PlusCode'])
-                
-                # Assign a physical mode
-                od_shop_mode.append('Physical')
-                # Add to physical counter for that person
-                pvh_opps[r['person_id']][0] += 1
-                
-                # if [r['store_PlusCode'], 'Hybrid'] not in store_modality:
-                #     store_modality.append([r['store_PlusCode'], 'Hybrid'])
-        # The person is not digitally literate so they definitely cannot access online
-        else:
-            od_shop_mode.append('Physical')
-            pvh_opps[r['person_id']][0] += 1
+    pvh_opps = dict(zip(index['person_ids'].tolist(), np.stack([POPCOUNT[physical].sum(axis=1), POPCOUNT[virtual].sum(axis=1), POPCOUNT[hybrid].sum(axis=1)], axis=1).tolist()))
+    
+    # Track total number of accessible opportunities by shopping modality; a store counts once under its best modality (hybrid, then physical, then virtual)
+    any_hybrid, any_physical, any_virtual = (np.unpackbits(np.bitwise_or.reduce(bits, axis=0), count=n_stores).astype(bool) for bits in (hybrid, physical, virtual))
+    any_physical &= ~any_hybrid
+    any_virtual &= ~(any_hybrid | any_physical)
+    
+    # Person - store edge list of every opportunity
+    od_modality = []
+    for shop_mode, bits in (('Hybrid', hybrid), ('Physical', physical), ('Virtual', virtual)):
+        person_pos, store_pos = np.nonzero(np.unpackbits(bits[persons], axis=1, count=n_stores))
+        od_modality.append(pd.DataFrame({'person_id': index['person_ids'][persons][person_pos],
+                                         'store_PlusCode': index['store_codes'][store_pos],
+                                         'Shop_Mode': shop_mode}))
+    od_modality = pd.concat(od_modality, ignore_index=True)
+    
+    return od_modality, pvh_opps, set(index['store_codes'][any_physical]), set(index['store_codes'][any_virtual]), set(index['store_codes'][any_hybrid])
 
-            if (r['store_PlusCode'] not in stores_hybrid_pluscode) & (r['store_PlusCode'] not in stores_physical_pluscode):
-                stores_physical_pluscode.append(r['store_PlusCode'])
 
-    # Add the shopping mode back to the data frame
-    od_condensed['Shop_Mode'] = od_shop_mode
+# Number of what-if scenarios scored at once, bounding the scenarios x people x stores bitsets held in memory
+SCENARIO_CHUNK_SIZE = 16
+
+def check_scenario(index, changes):
+    '''
+    Validate the changes of a what-if scenario (see evaluate_scenarios), raising a ValueError for an invalid one
+    
+    Unknown person_ids and store_codes are rejected rather than ignored.
+    Returns the changes with person_ids replaced by the positions of those people in the access index, whatever type their ids were given as
+    '''
+    if not isinstance(changes, list) or not all(isinstance(change, dict) for change in changes):
+        raise ValueError('Expected every scenario to have a list of changes')
+    person_positions = pd.Index(index['person_ids'].astype(str))
+    checked = []
+    for change in changes:
+        change = dict(change)
+        if change.get('type') not in ('set_digital_literacy', 'add_delivery', 'close_stores', 'extend_free_time'):
+            raise ValueError(f"Unknown scenario change: {change.get('type')}")
+        if change.get('type') in ('add_delivery', 'close_stores'):
+            if not isinstance(change.get('store_codes'), list):
+                raise ValueError(f"Expected a list of store_codes for {change['type']}")
+            unknown = [code for code in change['store_codes'] if not isinstance(code, str) or code not in index['store_codes']]
+            if unknown:
+                raise ValueError(f'Unknown store_codes: {unknown}')
+        # A string such as "false" would otherwise be truthy
+        if change.get('type') == 'set_digital_literacy' and not isinstance(change.get('value', True), bool):
+            raise ValueError('Expected a true/false value for set_digital_literacy')
+        if change.get('person_ids') is not None:
+            if not isinstance(change['person_ids'], list):
+                raise ValueError('Expected a list of person_ids')
+            # Ids are matched as strings, so that e.g. JSON strings match integer ids
+            positions = person_positions.get_indexer([str(person_id) for person_id in change['person_ids']])
+            if (positions < 0).any():
+                raise ValueError(f"Unknown person_ids: {[p for p, i in zip(change['person_ids'], positions) if i < 0]}")
+            change['person_ids'] = positions
+        if change.get('type') == 'extend_free_time':
+            if index['window_spare'] is None:
+                raise ValueError('Extending free time needs an OD built by od_builder.py')
+            minutes = change.get('minutes')
+            # Trips are only recorded up to what_if_minutes beyond every window, so longer extensions cannot be scored
+            if isinstance(minutes, bool) or not isinstance(minutes, (int, float)) or not 0 <= minutes <= index['what_if_minutes']:
+                raise ValueError(f"Expected free time to be extended by 0 to {index['what_if_minutes']} minutes")
+        checked.append(change)
+    return checked
+
+
+def score_scenarios(index, scenarios, online_store_codes, windows, base_reach):
+    '''
+    Re-score the opportunities of every person under a chunk of checked what-if scenarios (see evaluate_scenarios) in one pass
+    '''
+    n_scenarios, n_people, n_stores = len(scenarios), len(index['person_ids']), len(index['store_codes'])
+    reach = np.repeat(base_reach[None], n_scenarios, axis=0)
+    digitallit = np.repeat(index['digitallit'][None], n_scenarios, axis=0)
+    delivery = np.repeat(store_bits(index, online_store_codes)[None], n_scenarios, axis=0)
+    shop_online = np.repeat(index['shop_online_bits'][None], n_scenarios, axis=0)
+    open_stores = np.repeat(np.packbits(np.ones(n_stores, dtype=bool))[None], n_scenarios, axis=0)
+    
+    def changed_people(change):
+        if change.get('person_ids') is None:
+            return np.ones(n_people, dtype=bool)
+        return np.isin(np.arange(n_people), change['person_ids'])
+    
+    for s, changes in enumerate(scenarios):
+        for change in changes:
+            if change['type'] == 'set_digital_literacy':
+                digitallit[s, changed_people(change)] = bool(change.get('value', True))
+            elif change['type'] == 'add_delivery':
+                # Delivering stores can be reached online both virtually and as hybrid opportunities
+                delivering = store_bits(index, change['store_codes'])
+                delivery[s] |= delivering
+                shop_online[s] |= delivering
+            elif change['type'] == 'close_stores':
+                open_stores[s] &= ~store_bits(index, change['store_codes'])
+            elif change['type'] == 'extend_free_time':
+                persons = changed_people(change)
+                reach[s, persons] = window_reach(index, windows, extended_window_bits(index, windows, float(change['minutes'])))[persons]
+    
+    # Closed stores can be reached neither in person nor online
+    reach &= open_stores[:, None, :]
+    literate = digitallit[:, :, None]
+    hybrid = np.where(literate, reach & shop_online[:, None, :], 0).astype(np.uint8)
+    physical = reach & ~hybrid
+    virtual = np.where(literate, (delivery & open_stores)[:, None, :] & ~reach, 0).astype(np.uint8)
+    
+    person_opps = np.stack([POPCOUNT[physical].sum(axis=2), POPCOUNT[virtual].sum(axis=2), POPCOUNT[hybrid].sum(axis=2)], axis=2)
+    
+    # A store counts once under its best modality (hybrid, then physical, then virtual)
+    any_hybrid, any_physical, any_virtual = (np.unpackbits(np.bitwise_or.reduce(bits, axis=1), axis=1, count=n_stores).astype(bool) for bits in (hybrid, physical, virtual))
+    any_physical &= ~any_hybrid
+    any_virtual &= ~(any_hybrid | any_physical)
+    counters = np.stack([any_physical.sum(axis=1), any_virtual.sum(axis=1), any_hybrid.sum(axis=1)], axis=1)
+    
+    return person_opps, counters
 
-    edges_temp = []
 
-    # Identify virtual access-only options
+def evaluate_scenarios(index, scenarios, online_store_codes, start=None, end=None):
+    '''
+    Re-score the opportunities of every person under a batch of what-if scenarios
+    
+    Every scenario is a list of changes, each a dict with a 'type' of:
+    'set_digital_literacy' ('value' true/false, for 'person_ids' or everyone), 'add_delivery' ('store_codes'), 'close_stores' ('store_codes'),
+    or 'extend_free_time' ('minutes', from 0 to the what_if_minutes of the index, for 'person_ids' or everyone; needs an OD built by od_builder.py).
+    Every scenario is checked first (see check_scenario); changes are then applied to per-scenario copies of the reachability, digital literacy,
+    and online store bitsets, and SCENARIO_CHUNK_SIZE scenarios at a time are classified in one pass with the rules of access_index_modalities
+    over all people and stores, using the free-time windows contained in [start, end].
+    
+    Returns the per-person [physical, virtual, hybrid] counts (scenarios x people x 3) and the [physical, virtual, hybrid] counters (scenarios x 3)
+    '''
+    scenarios = [check_scenario(index, changes) for changes in scenarios]
+    windows = query_interval_index(index['window_interval_index'], start, end)
+    base_reach = window_reach(index, windows, index['window_bits'][windows])
+    
+    person_opps = np.zeros((len(scenarios), len(index['person_ids']), 3), dtype=int)
+    counters = np.zeros((len(scenarios), 3), dtype=int)
+    for first in range(0, len(scenarios), SCENARIO_CHUNK_SIZE):
+        chunk = slice(first, first + SCENARIO_CHUNK_SIZE)
+        person_opps[chunk], counters[chunk] = score_scenarios(index, scenarios[chunk], online_store_codes, windows, base_reach)
+    return person_opps, counters
+
+
+# Registry of every store by PlusCode with its attributes, color, and whether it can be accessed online,
+# so stores are looked up (e.g., in the network) without scanning the stores data-frame
+store_registry = stores.drop_duplicates('PlusCode').set_index('PlusCode')
+store_registry['color'] = store_registry['Type'].map(store_colors)
+store_registry['online'] = store_registry.index.isin(stores_online['PlusCode'])
+# The same as records, for lookups of single stores
+store_attributes = store_registry[['Name', 'Type', 'color', 'online']].to_dict('index')
 
-    # For everyone who is digitally literate
-    for i_pers, r_pers in individuals_df[individuals_df['digitallit'] == 'yes'].iterrows():
-        # For every online store
-        for so in stores_online_df['PlusCode']:
-            # If there isn't an entry already in the od_condensed edge list of person_id, store_PlusCode, and Shop_Mode
-            # We'll add a virtual connection to that store for that person
-            if len(od_condensed[(od_condensed['person_id'] == r_pers['person_id']) & (od_condensed['store_PlusCode'] == so)]) == 0:
-                edges_temp.append({'person_id':r_pers['person_id'], 'store_PlusCode': so, 'Shop_Mode': 'Virtual'})
-                pvh_opps[r_pers['person_id']][1] += 1
-                
-                # If the Store PlusCode for a virtual shopping option isn't already in the physical, hybrid, or virtual lists, add it to the virtual list
-                if (so not in stores_hybrid_pluscode) & (so not in stores_physical_pluscode) & (so not in stores_virtual_pluscode):
-                    stores_virtual_pluscode.append(so)
-            else:
-                next
+# https://medium.com/plotly/introducing-dash-cytoscape-ce96cac824e4
+#https://github.com/plotly/dash-cytoscape/blob/master/usage-stylesheet.py
+def network_data(od_modality, pvh_opps, individuals_df, highlights=None):
+    '''
+    Build the Cytoscape edges and nodes of the food network
+    
+    Colors are carried as element data so that the stylesheet needs no rule per element; highlights (element id -> highlight classes
+    set by tapping nodes) are kept as classes of the elements
+    '''
+    highlights = highlights or {}
+    def element_classes(element_id, base_class):
+        return ' '.join([base_class] + highlights.get(element_id, []))
 
-    edges_temp_df = pd.DataFrame(edges_temp)
-    od_condensed = pd.concat([od_condensed, edges_temp_df], ignore_index=True)
-    #od_condensed = od_condensed.sort_values(by=['person_id']).reset_index(drop=True)
+    od_condensed = od_modality[['person_id', 'store_PlusCode', 'Shop_Mode']]
 
     od_p_p = [{'person_id': 1, 'store_PlusCode': 18, 'Shop_Mode': 'Hybrid'},
               {'person_id': 18, 'store_PlusCode': 19, 'Shop_Mode': 'Hybrid'},
@@ -634,80 +1028,314 @@ def network_data(od_df, individuals_df, stores_df, stores_online_df):
     # Remove duplicates
     od_p_p = [dict(t) for t in {tuple(d.items()) for d in od_p_p}]      
     
-    od_condensed = pd.concat([od_condensed, pd.DataFrame(od_p_p)], ignore_index=True).sort_values(by=['person_id']).reset_index(drop=True)
+    od_condensed = pd.concat([od_condensed, pd.DataFrame(od_p_p, columns=['person_id', 'store_PlusCode', 'Shop_Mode'])], ignore_index=True).sort_values(by=['person_id'], kind='stable').reset_index(drop=True)
     
-    nodes = set()
-    cy_edges = []
-    cy_nodes = []
-
     pvh_opps_df = pd.DataFrame.from_dict(pvh_opps, orient='index', columns=['PhysicalOpp', 'VirtualOpp', 'HybridOpp'])
     pvh_opps_df['TotalOpps'] = pvh_opps_df.sum(axis=1)
     
-    for i, r in od_condensed.iterrows():
-        
-        # If the node ID is not in the nodes set
-        if str(r['person_id']) not in nodes:
+    # Every edge carries its modality and a stable id (a person reaches a store by one modality only) so a tapped node's edges can be highlighted without looking them up
+    class_colors = od_condensed['Shop_Mode'].map({'Hybrid': 'hybrid', 'Physical': 'physical', 'Virtual': 'virtual'}).fillna('self')
+    cy_edges = [{'data': {'id': f'{source}-{target}', 'source': str(source), 'target': str(target), 'modality': class_color, 'color': edge_colors[class_color]},
+                 'classes': element_classes(f'{source}-{target}', class_color)}
+                for source, target, class_color in zip(od_condensed['person_id'], od_condensed['store_PlusCode'], class_colors)]
+    
+    # Size people by their total accessible opportunities; people without any connection keep the minimum size
+    person_ids = individuals['person_id'].unique()
+    person_sizes = (np.sqrt(1 + pvh_opps_df['TotalOpps'].reindex(person_ids).fillna(0)) * 2).astype(int)
+    person_sizes = person_sizes.where(pd.Series(person_ids, index=person_ids).isin(od_condensed['person_id']), 1)
+    cy_nodes = [{'data': {'id': str(p), 'label': f'Person {p}', 'node_size': int(node_size), 'color': indiv_colors[p]}, 'classes': element_classes(str(p), 'person')}
+                for p, node_size in zip(person_ids, person_sizes)]
+    
+    # Size stores by the number of people who can access them
+    people_to_store = od_condensed.groupby('store_PlusCode')['person_id'].nunique()
+    store_sizes = (np.sqrt(1 + people_to_store.reindex(store_registry.index)) * 3).fillna(1).astype(int)
+    cy_nodes.extend({'data': {'id': str(s), 'label': f"{store_attributes[s]['Name']} - {s}", 'node_size': int(node_size),
+                              'name': store_attributes[s]['Name'], 'store_type': store_attributes[s]['Type'], 'color': store_attributes[s]['color']},
+                     'classes': element_classes(str(s), 'store')}
+                    for s, node_size in zip(store_registry.index, store_sizes))
             
-            # Add the node to nodes set
-            nodes.add(str(r['person_id']))
+    return cy_edges, cy_nodes
+
+# Attributes people and stores can be grouped by in the aggregated network
+PERSON_GROUPINGS = {'travelmode': 'Travel Mode', 'digitallit': 'Digital Literacy', 'sex': 'Sex', 'raceethnic': 'Race/Ethnicity',
+                    'dietarypref': 'Dietary Preferences', 'job': 'Job', 'physical': 'Physical Disability', 'snapbenefit': 'SNAP Benefits'}
+STORE_GROUPINGS = {'Type': 'Store Type'}
+
+def aggregate_network_data(od_modality, individuals_df, person_grouping, store_grouping, expanded=(), highlights=None):
+    '''
+    Build the Cytoscape edges and nodes of the food network with people grouped by one of their attributes and stores by one of theirs
+    
+    Each edge between groups stands for all the (person, store) opportunities of a modality between their members and carries their count;
+    groups listed in expanded (by node id) are shown as their members instead. Either grouping can be None to show every person or store.
+    '''
+    highlights = highlights or {}
+    def element_classes(element_id, base_classes):
+        return ' '.join([base_classes] + highlights.get(element_id, []))
+    
+    # Node each person and store is shown as
+    people = individuals_df.drop_duplicates('person_id').set_index('person_id')
+    person_nodes = pd.Series(people.index.astype(str), index=people.index)
+    if person_grouping:
+        person_groups = f'group:person:{person_grouping}:' + people[person_grouping].fillna('Unknown').astype(str)
+        person_nodes = person_groups.where(~person_groups.isin(expanded), person_nodes)
+    
+    store_nodes = pd.Series(store_registry.index.astype(str), index=store_registry.index)
+    if store_grouping:
+        store_groups = f'group:store:{store_grouping}:' + store_registry[store_grouping].fillna('Unknown').astype(str)
+        store_nodes = store_groups.where(~store_groups.isin(expanded), store_nodes)
+    
+    # Count the opportunities of every modality between every pair of nodes
+    od_nodes = pd.DataFrame({'source': od_modality['person_id'].map(person_nodes).to_numpy(),
+                             'target': od_modality['store_PlusCode'].map(store_nodes).to_numpy(),
+                             'person_id': od_modality['person_id'].to_numpy(),
+                             'modality': od_modality['Shop_Mode'].str.lower().to_numpy()}).dropna(subset=['source', 'target'])
+    edge_counts = od_nodes.groupby(['source', 'target', 'modality']).size().reset_index(name='count')
+    cy_edges = [{'data': {'id': f'{source}-{target}-{modality}', 'source': source, 'target': target, 'modality': modality, 'color': edge_colors[modality],
+                          'count': int(count), 'width': float(1 + np.log2(count))},
+                 'classes': element_classes(f'{source}-{target}-{modality}', modality)}
+                for source, target, modality, count in edge_counts.itertuples(index=False)]
+    
+    # People are sized by their opportunities and stores by the people who can access them, as in the individual network
+    person_opps = od_nodes.groupby('source').size()
+    store_people = od_nodes.groupby('target')['person_id'].nunique()
+    
+    cy_nodes = []
+    for node_id, members in person_nodes.groupby(person_nodes).groups.items():
+        if node_id.startswith('group:'):
+            value = node_id.split(':', 3)[3]
+            cy_nodes.append({'data': {'id': node_id, 'label': f"{PERSON_GROUPINGS[person_grouping]}: {value} ({len(members)} {'person' if len(members) == 1 else 'people'})", 'members': len(members),
+                                      'node_size': int(np.sqrt(1 + person_opps.get(node_id, 0)) * 2), 'color': 'grey'},
+                             'classes': element_classes(node_id, 'person group')})
+        else:
+            p = members[0]
+            cy_nodes.append({'data': {'id': node_id, 'label': f'Person {p}', 'node_size': int(np.sqrt(1 + person_opps.get(node_id, 0)) * 2), 'color': indiv_colors[p]},
+                             'classes': element_classes(node_id, 'person')})
+    for node_id, members in store_nodes.groupby(store_nodes).groups.items():
+        if node_id.startswith('group:'):
+            value = node_id.split(':', 3)[3]
+            cy_nodes.append({'data': {'id': node_id, 'label': f"{value} ({len(members)} {'store' if len(members) == 1 else 'stores'})", 'members': len(members),
+                                      'node_size': int(np.sqrt(1 + store_people.get(node_id, 0)) * 3), 'color': store_colors.get(value, 'grey')},
+                             'classes': element_classes(node_id, 'store group')})
+        else:
+            s = members[0]
+            cy_nodes.append({'data': {'id': node_id, 'label': f"{store_attributes[s]['Name']} - {s}", 'node_size': int(np.sqrt(1 + store_people.get(node_id, 0)) * 3),
+                                      'name': store_attributes[s]['Name'], 'store_type': store_attributes[s]['Type'], 'color': store_attributes[s]['color']},
+                             'classes': element_classes(node_id, 'store')})
+    
+    return cy_edges, cy_nodes
+
+# Node positions of the network computed on the server, keyed by a hash of the network topology; least recently used entries are evicted first
+NETWORK_LAYOUT_CACHE_SIZE = 16
+network_layout_cache = OrderedDict()
+
+def network_topology(elements):
+    '''
+    Retrieve the node ids, the (source, target) pairs of the edges, and a hash identifying the topology of a network from its Cytoscape elements
+    '''
+    node_ids = sorted(element['data']['id'] for element in elements if 'source' not in element['data'])
+    edges = sorted((element['data']['source'], element['data']['target']) for element in elements if 'source' in element['data'])
+    topology_hash = hashlib.sha256(json.dumps([node_ids, edges]).encode()).hexdigest()
+    return node_ids, edges, topology_hash
+
+# Largest network laid out with the force-directed layout; larger networks get a concentric layout (see concentric_layout)
+FORCE_LAYOUT_MAX_NODES = 3000
+# Largest network whose repulsion is computed exactly, over every pair of nodes at once (at most 16 MB); larger networks approximate it
+EXACT_REPULSION_MAX_NODES = 1000
+
+# Offsets of the cells of a grid level that are neighbors of a node's cell one level up but not of its own cell (see approximate_repulsion)
+FAR_CELL_OFFSETS = np.array([(dx, dy) for dx in range(-3, 4) for dy in range(-3, 4) if max(abs(dx), abs(dy)) > 1])
+
+def grid_pairs(cells):
+    '''
+    Retrieve the (i, j) pairs of distinct nodes in the same or neighboring grid cells (integer cell coordinates of every node), one array of each per neighboring cell offset
+    '''
+    n = len(cells)
+    # Cells are numbered row by row, with a margin of one cell so that the neighbors of every cell have a valid number
+    width = cells[:, 0].max() + 3
+    cell = (cells[:, 1] + 1) * width + cells[:, 0] + 1
+    order = np.argsort(cell, kind='stable')
+    sorted_cells = cell[order]
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            neighbor = cell + dy * width + dx
+            first, last = np.searchsorted(sorted_cells, neighbor, 'left'), np.searchsorted(sorted_cells, neighbor, 'right')
+            counts = last - first
+            i = np.repeat(np.arange(n), counts)
+            j = order[np.arange(counts.sum()) + np.repeat(first - (np.cumsum(counts) - counts), counts)]
+            yield i[i != j], j[i != j]
+
+def exact_repulsion(pos, k):
+    '''
+    Compute the Fruchterman-Reingold repulsion (k^2 / distance) between every pair of nodes
+    '''
+    delta = pos[:, None, :] - pos[None, :, :]
+    dist_sq = np.maximum((delta ** 2).sum(axis=2), 1e-9)
+    return (delta * (k ** 2 / dist_sq)[:, :, None]).sum(axis=1)
+
+def approximate_repulsion(pos, k):
+    '''
+    Approximate the Fruchterman-Reingold repulsion (k^2 / distance) between every pair of nodes, Barnes-Hut style, over a hierarchy of grids
+    
+    At every level of grids of 2 x 2, 4 x 4, ... cells, a node is repelled by the centroid (weighted by the number of nodes) of every cell
+    next to its parent cell but not next to its own cell; at the finest level, where cells hold about one node, nodes in the same or
+    neighboring cells repel each other exactly. Every other node is thus accounted for once, at a cost of about n log n per call.
+    '''
+    n = len(pos)
+    disp = np.zeros((n, 2))
+    unit = (pos - pos.min(axis=0)) / (max(np.ptp(pos, axis=0).max(), 1e-9) * (1 + 1e-9))
+    depth = int(np.ceil(np.log(max(n, 2)) / np.log(4))) + 1
+    for level in range(1, depth + 1):
+        size = 2 ** level
+        cells = (unit * size).astype(int)
+        cell = cells[:, 1] * size + cells[:, 0]
+        mass = np.bincount(cell, minlength=size * size)
+        centroid = np.column_stack([np.bincount(cell, weights=pos[:, axis], minlength=size * size) for axis in (0, 1)]) / np.maximum(mass, 1)[:, None]
         
-            node_size = int(np.sqrt(1 + pvh_opps_df[pvh_opps_df.index == r['person_id']]['TotalOpps'].values[0]) * 2)
-            id_label = f"Person {r['person_id']}"
-            cy_nodes.append({'data': {'id': str(r['person_id']),
-                                      'label': id_label,
-                                      'node_size': node_size},
-                             'classes': 'person'
-                            }) 
+        # Cells next to the parent cell (in this level's coordinates, from 2 below to 3 above the parent's first child) but not next to the node's own
+        target = cells[:, None, :] + FAR_CELL_OFFSETS[None]
+        parity = cells[:, None, :] & 1
+        valid = ((FAR_CELL_OFFSETS >= -2 - parity) & (FAR_CELL_OFFSETS <= 3 - parity) & (target >= 0) & (target < size)).all(axis=2)
+        target_cell = np.where(valid, target[:, :, 1] * size + target[:, :, 0], 0)
+        count = np.where(valid, mass[target_cell], 0)
+        delta = pos[:, None, :] - centroid[target_cell]
+        dist_sq = np.maximum((delta ** 2).sum(axis=2), 1e-9)
+        disp += (delta * (count * k ** 2 / dist_sq)[:, :, None]).sum(axis=1)
+    
+    # Nodes in the same or neighboring cells of the finest level repel each other exactly
+    for i, j in grid_pairs(cells):
+        delta = pos[i] - pos[j]
+        force = k ** 2 / np.maximum((delta ** 2).sum(axis=1), 1e-9)
+        for axis in (0, 1):
+            disp[:, axis] += np.bincount(i, weights=delta[:, axis] * force, minlength=n)
+    return disp
+
+def force_directed_layout(node_ids, edges, initial_positions=None, iterations=100, temperature=0.1, gravity=10, seed=0):
+    '''
+    Lay out a graph with the Fruchterman-Reingold force-directed algorithm in a unit square
+    
+    Nodes with a position in initial_positions start there, and nodes without one start next to their positioned neighbors (or randomly).
+    Repulsion between the nodes of networks larger than EXACT_REPULSION_MAX_NODES is approximated over a hierarchy of grids (see approximate_repulsion),
+    so every iteration costs about n log n time and memory rather than n^2; gravity keeps unconnected nodes close
+    '''
+    rng = np.random.default_rng(seed)
+    n = len(node_ids)
+    if n == 0:
+        return {}
+    node_index = {node_id: i for i, node_id in enumerate(node_ids)}
+    src = np.array([node_index[s] for s, t in edges if s in node_index and t in node_index], dtype=int)
+    dst = np.array([node_index[t] for s, t in edges if s in node_index and t in node_index], dtype=int)
+    
+    # Starting positions
+    pos = rng.random((n, 2))
+    known = np.zeros(n, dtype=bool)
+    for node_id, xy in (initial_positions or {}).items():
+        if node_id in node_index:
+            pos[node_index[node_id]] = xy
+            known[node_index[node_id]] = True
+    if known.any() and not known.all():
+        # Place new nodes at the mean of their positioned neighbors, slightly jittered
+        neighbor_sum, neighbor_count = np.zeros((n, 2)), np.zeros(n)
+        for a, b in ((src, dst), (dst, src)):
+            from_known = known[b]
+            np.add.at(neighbor_sum, a[from_known], pos[b[from_known]])
+            np.add.at(neighbor_count, a[from_known], 1)
+        placed = ~known & (neighbor_count > 0)
+        pos[placed] = neighbor_sum[placed] / neighbor_count[placed, None] + rng.normal(0, 0.01, (placed.sum(), 2))
+    
+    # Optimal distance between nodes
+    k = 1 / np.sqrt(n)
+    repulsion = exact_repulsion if n <= EXACT_REPULSION_MAX_NODES else approximate_repulsion
+    for iteration in range(iterations):
+        # Every pair of nodes repels
+        disp = repulsion(pos, k)
         
-        # If the node is a store and not already in the nodes set
-        if (str(r['store_PlusCode']) not in nodes) & (str(r['store_PlusCode']).isdigit() == False):
-            
-            # Add the store node to the nodes set
-            nodes.add(str(r['store_PlusCode']))
-            people_to_store = od_condensed[od_condensed['store_PlusCode'] == r['store_PlusCode']]['person_id'].nunique()
-            node_size = int(np.sqrt(1 + people_to_store) * 3)
-            id_label = f"{r['store_PlusCode']}" # if r['store_PlusCode'].isdigit() else f"{r['store_PlusCode']}"
-            cy_nodes.append({'data': {'id': str(r['store_PlusCode']), 'label': stores[stores['PlusCode'] == r['store_PlusCode']]['Name'].values[0] + ' - ' + r['store_PlusCode'], 'node_size': node_size}, 'classes': 'store'})
-                        
-        class_color = 'self'
+        # Connected nodes attract; forces are summed per node with weighted bincounts
+        delta = pos[src] - pos[dst]
+        force = np.sqrt((delta ** 2).sum(axis=1)) / k
+        for axis in (0, 1):
+            disp[:, axis] += np.bincount(dst, weights=delta[:, axis] * force, minlength=n) - np.bincount(src, weights=delta[:, axis] * force, minlength=n)
         
-        if r['Shop_Mode'] == 'Hybrid':
-            class_color = 'hybrid'
-        elif r['Shop_Mode'] == 'Physical':
-            class_color = 'physical'
-        elif r['Shop_Mode'] == 'Virtual':
-            class_color = 'virtual'
-            
-        cy_edges.append({
-            'data': {
-                'source': str(r['person_id']),
-                'target': str(r['store_PlusCode'])
-            },
-            'classes': class_color
-        })
-      
-    for p in individuals['person_id'].unique():
-        if not any(n['data']['id'] == str(p) for n in cy_nodes):
-            id_label = 'Person ' + str(p)
-            cy_nodes.append({'data': {'id': str(p), 'label': id_label, 'node_size': 1}, 'classes': 'person'})
-
-    for s in stores['PlusCode'].unique():
-        if not any(n['data']['id'] == str(s) for n in cy_nodes):
-            if s.isdigit():
-                cy_nodes.append({'data': {'id': str(s), 'label': f'Person {str(p)}', 'node_size': 1}, 'classes': 'store'})
-            else:
-                id_label = stores[stores['PlusCode'] == s]['Name'].values[0] + ' - ' + str(s)
-                cy_nodes.append({'data': {'id': str(s), 'label': id_label, 'node_size': 1}, 'classes': 'store'})   
-            
-    return cy_edges, cy_nodes, pvh_opps, set(stores_physical_pluscode), set(stores_virtual_pluscode), set(stores_hybrid_pluscode)
+        # Gravity pulls every node towards the center so that nodes without edges are not pushed to the far edges of the canvas
+        disp -= (pos - pos.mean(axis=0)) * gravity * n * k ** 2
+        
+        # Move every node along its displacement, by at most the current temperature, which cools linearly
+        length = np.maximum(np.sqrt((disp ** 2).sum(axis=1)), 1e-9)
+        step = temperature * (1 - iteration / iterations)
+        pos += disp * (np.minimum(length, step) / length)[:, None]
+    
+    return dict(zip(node_ids, pos.tolist()))
+
+def concentric_layout(node_ids, edges):
+    '''
+    Lay out a graph on a sunflower spiral in a unit square, nodes with the most edges at the center, for networks too large for force_directed_layout
+    '''
+    node_index = pd.Index(node_ids)
+    degree = np.bincount(node_index.get_indexer([node for edge in edges for node in edge]) + 1, minlength=len(node_ids) + 1)[1:]
+    rank = np.empty(len(node_ids))
+    rank[np.argsort(-degree, kind='stable')] = np.arange(len(node_ids))
+    radius, angle = np.sqrt((rank + 0.5) / max(len(node_ids), 1)) / 2, rank * np.pi * (3 - np.sqrt(5))
+    return dict(zip(node_ids, np.column_stack([0.5 + radius * np.cos(angle), 0.5 + radius * np.sin(angle)]).tolist()))
+
+def network_layout(elements, previous_layout=None, width=1000, height=1000):
+    '''
+    Retrieve a Cytoscape preset layout with server-side precomputed positions of the nodes of a network
+    
+    Positions are computed once per topology; a new topology starts from the positions of the session's previous preset layout (if any)
+    so that only the few nodes or edges that changed need to settle. Networks of more than FORCE_LAYOUT_MAX_NODES nodes are laid out concentrically
+    '''
+    node_ids, edges, topology_hash = network_topology(elements)
+    if topology_hash in network_layout_cache:
+        network_layout_cache.move_to_end(topology_hash)
+        positions = network_layout_cache[topology_hash]
+    else:
+        # Scale the canvas positions of the previous preset layout back to the unit square
+        previous_positions = {node_id: (xy['x'] / width, xy['y'] / height)
+                              for node_id, xy in ((previous_layout or {}).get('positions') or {}).items()}
+        new_nodes = sum(node_id not in previous_positions for node_id in node_ids)
+        if len(node_ids) > FORCE_LAYOUT_MAX_NODES:
+            positions = concentric_layout(node_ids, edges)
+        elif previous_positions and new_nodes < len(node_ids):
+            # Only the new nodes and their neighborhood have to settle, so the fewer nodes are new, the fewer (and cooler) iterations are run
+            positions = force_directed_layout(node_ids, edges, previous_positions, iterations=int(np.clip(100 * new_nodes / len(node_ids), 5, 30)),
+                                              temperature=0.02, seed=int(topology_hash[:8], 16))
+        else:
+            positions = force_directed_layout(node_ids, edges, seed=int(topology_hash[:8], 16))
+        network_layout_cache[topology_hash] = positions
+        if len(network_layout_cache) > NETWORK_LAYOUT_CACHE_SIZE:
+            network_layout_cache.popitem(last=False)
+    
+    # Scale the unit square to the canvas
+    xy = np.array(list(positions.values())).reshape(-1, 2)
+    lo, span = xy.min(axis=0), np.maximum(np.ptp(xy, axis=0), 1e-9)
+    return {'name': 'preset',
+            'fit': True,
+            'positions': {node_id: {'x': (x - lo[0]) / span[0] * width, 'y': (y - lo[1]) / span[1] * height} for node_id, (x, y) in positions.items()}}
 
 ############################################################################################
 # Create 2D and 3D Map and network data
 #map_2d = create_2d_map('Select Block Group Choropleth Layer', individuals, trajectories, stores) 
 
-map_2d = create_2d_map('Select Block Group Choropleth Layer', individuals, trajectories, stores, prisms) 
+# R-trees over store points, block groups, and prisms for viewport queries, point-in-polygon joins, and nearest-store lookups
+stores_spatial_index = build_spatial_index(stores[['Longitude', 'Latitude', 'Longitude', 'Latitude']].to_numpy())
+knox_bg_spatial_index = build_spatial_index(knox_bg.bounds.to_numpy())
+prisms_spatial_index = build_spatial_index(prisms.bounds.to_numpy())
+
+# Serialize the geometries of the choropleth layers once
+layer_features = {'Block Groups': serialize_layer_features(knox_bg_lods),
+                  'Space Time Prisms': serialize_layer_features(prisms_lods)}
+
+map_2d = create_2d_map('Select Block Group Choropleth Layer', individuals, trajectories, stores, prisms, MAP_2D_LOD, MAP_2D_REGION) 
 map_3d = create_3d_map(trajectories, stores, individuals, individuals)
-cy_edges, cy_nodes, all_opps, stores_physical_pluscode, stores_virtual_pluscode, stores_hybrid_pluscode = network_data(od, individuals, stores, stores_online)
+
+# Person x store x free-time window index used to answer every reachability query
+access_index = build_access_index(od, individuals, stores, od_what_if_minutes())
+reach_all = query_access_index(access_index, None, None, individuals['person_id'])
+od_modality, all_opps, stores_physical_pluscode, stores_virtual_pluscode, stores_hybrid_pluscode = access_index_modalities(access_index, reach_all, individuals['person_id'], stores['PlusCode'], stores_online['PlusCode'])
+cy_edges, cy_nodes = network_data(od_modality, all_opps, individuals)
+
+# Interval indexes over prism free-time windows and trajectory timestamps for date-range queries
+prisms_interval_index = build_interval_index(prisms['free_time_start'], prisms['free_time_end'])
+trajectories_interval_index = build_interval_index(trajectories['daytime'], trajectories['daytime'])
 
 # Total accessible opportunities by shopping modality
 physical_opp_total_all = len(stores_physical_pluscode)
@@ -725,90 +1353,148 @@ individuals = pd.merge(individuals.drop(columns=['PhysicalOpp', 'VirtualOpp']),
 # CSS Stylesheet for the Dashboard HTML
 external_stylesheets = ['https://use.fontawesome.com/releases/v6.0.0/css/all.css', dbc.themes.ZEPHYR]#, 'https://fonts.googleapis.com/css2?family=Playfair+Display&display=swap']#, 'https://codepen.io/chriddyp/pen/bWLwgP.css']
 
-# Default Stylesheet for Network Graph
-edge_colors = {'physical': '#5cb85c', 'virtual': '#0275d8', 'hybrid': 'yellow', 'self': 'grey'}
-cytoscape_stylesheet = []
-default_stylesheet = [
-    {
-        "selector": 'node',
-        'style': {
-            "opacity": 0.95,
-            "width": "data(node_size)",
-            "height": "data(node_size)"
-        }
-    },
-    {
-        "selector": 'edge',
-        'style': {
-            "curve-style": "bezier",
-            "opacity": 0.65
-        }
-    },
-    {
-        'selector': '.hybrid',
-        'style': {
-            'background-color': 'yellow',
-            'line-color': 'yellow'
-        }
-    },
-    {
-        'selector': '.physical',
-        'style': {
-            'background-color': '#5cb85c',
-            'line-color': '#5cb85c'
-        }
-    },
-    {
-        'selector': '.virtual',
-        'style': {
-            'background-color': '#0275d8',
-            'line-color': '#0275d8'
+# Highlight classes added to network elements by tapping nodes: the tapped nodes, the nodes connected to them, and the edges between them
+HIGHLIGHT_CLASSES = ['connected', 'highlighted', 'tapped']
+
+def network_stylesheet(person_shape='pentagon', store_shape='ellipse', focused=False):
+    '''
+    Build the stylesheet of the network graph
+    
+    Colors come from element data and highlights from a fixed set of classes, so the stylesheet has the same few rules however large the network
+    and however many nodes are tapped. Once a node is tapped (focused), everything but the highlighted elements fades out.
+    '''
+    stylesheet = [
+        {
+            "selector": 'node',
+            'style': {
+                'background-color': 'data(color)',
+                "opacity": 0.95,
+                "width": "data(node_size)",
+                "height": "data(node_size)"
+            }
+        },
+        {
+            "selector": 'edge',
+            'style': {
+                "curve-style": "bezier",
+                "opacity": 0.65
+            }
+        },
+        {
+            'selector': '.hybrid',
+            'style': {
+                'line-color': edge_colors['hybrid']
+            }
+        },
+        {
+            'selector': '.physical',
+            'style': {
+                'line-color': edge_colors['physical']
+            }
+        },
+        {
+            'selector': '.virtual',
+            'style': {
+                'line-color': edge_colors['virtual']
+            }
+        },
+        {
+            'selector': '.person',
+            'style': {
+                'shape': person_shape,
+            }
+        },  {
+            'selector': '.store',
+            'style': {
+                'shape': store_shape,
+            }    
+        },  {
+            'selector': '.self',
+            'style': {
+                'line-color': 'white',
+                "opacity": 0
+            }    
+        },  {
+            # Edges of the aggregated network are as wide as the number of opportunities they stand for
+            'selector': 'edge[width]',
+            'style': {
+                'width': 'data(width)'
+            }
+        },  {
+            # Groups of the aggregated network are always labelled; tapping one expands it into its members
+            'selector': 'node.group',
+            'style': {
+                'label': 'data(label)',
+                'font-family': 'Roboto',
+                'font-size': 30,
+                'border-width': 2,
+                'border-color': 'black'
+            }
         }
-    },
-    {
-        'selector': '.person',
-        'style': {
-            'shape': 'pentagon',
-            "width": "data(node_size)",
-            "height": "data(node_size)"
+    ]
+    if not focused:
+        return stylesheet
+    
+    return stylesheet + [
+        {
+            'selector': 'node',
+            'style': {
+                'opacity': 0.2,
+            }
+        }, {
+            'selector': 'edge',
+            'style': {
+                'opacity': 0.0,
+                'z-index': 1
+            }
+        }, {
+            'selector': 'node.connected',
+            'style': {
+                'opacity': 0.9,
+                "label": 'data(label)',
+                "color": "black",
+                "text-opacity": 1,
+                'font-family': 'Roboto',
+                "font-size": 30,
+                'z-index': 9999
+            }
+        }, {
+            "selector": 'edge.highlighted',
+            "style": {
+                "mid-target-arrow-color": 'data(color)',
+                "mid-target-arrow-shape": "vee",
+                "line-color": 'data(color)',
+                'opacity': 0.9,
+                'z-index': 9999
+            }
+        }, {
+            'selector': 'node.tapped',
+            'style': {
+                "border-width": 2,
+                "border-opacity": 1,
+                "opacity": 1,
+                'label': "data(label)",
+                "text-opacity": 1,
+                'font-family': 'Roboto',
+                "font-size": 40,
+                'color': 'black',
+                'z-index': 9999
+            }
+        }, {
+            'selector': '.person.tapped',
+            'style': {
+                "border-color": "purple",
+            }
+        }, {
+            'selector': '.store.tapped',
+            'style': {
+                'border-color': '#D2F6D0',
+            }
         }
-    },  {
-        'selector': '.store',
-        'style': {
-            'shape': 'ellipse',
-            "width": "data(node_size)",
-            "height": "data(node_size)"
-        }    
-    },  {
-        'selector': '.self',
-        'style': {
-            'background-color': 'white',
-            'line-color': 'white',
-            "width": "data(node_size)",
-            "height": "data(node_size)",
-            "opacity": 0
-        }    
-    }
-]
-for n in cy_nodes:
-    if n['classes'] == 'person':
-        default_stylesheet.append({'selector': 'node[id = "{}"]'.format(n['data']['id']),
-                                    'style': {
-                                        'background-color': indiv_colors[int(n['data']['id'])],
-                                        "opacity": 0.95,
-                                        "width": "data(node_size)",
-                                        "height": "data(node_size)"
-                                    }   
-                            })
-    elif n['classes'] == 'store':
-        default_stylesheet.append({'selector': 'node[id = "{}"]'.format(n['data']['id']),
-                                    'style': {
-                                        'background-color': store_colors[stores[stores['PlusCode'] == n['data']['id']]['Type'].values[0]],
-                                        "opacity": 0.95,
-                                        "width": "data(node_size)",
-                                        "height": "data(node_size)"
-                                    }   
-                            })        
+    ]
+
+# Default Stylesheet for Network Graph
+default_stylesheet = network_stylesheet()
 
 styles = {
     'json-output': {
@@ -1130,6 +1816,12 @@ app.layout = dbc.Container([
                 figure = map_2d,
                 config={"displaylogo": False},
                 ),
+            # Level of detail of the geometries, region (None for everything) of the stores and polygons, and choropleth layer currently shown in the 2-D map
+            dcc.Store(id='map-2d-view', data={'lod': MAP_2D_LOD, 'region': MAP_2D_REGION, 'layer': 'Select Block Group Choropleth Layer'}),
+            # People, stores, and time range currently shown in the tables and maps
+            dcc.Store(id='filter-state'),
+            # person_id's of the trajectories deactivated in the legend of the 3-D plot in this session
+            dcc.Store(id='legend-tracker', data=[]),
             dbc.Row([
                 dbc.Col([
                     dash_datetimepicker.DashDatetimepicker(
@@ -1178,8 +1870,11 @@ app.layout = dbc.Container([
                 cyto.Cytoscape(
                     id='cytoscape',
                     elements=cy_edges + cy_nodes,
+                    stylesheet=default_stylesheet,
                     style={'height': '53vh'}, #'width': '100%'
                 ),
+                # Highlight classes of the network elements set by tapping nodes in this session
+                dcc.Store(id='network-highlights', data={}),
             ], width = 10, style={'display': 'inline-block', 'align-items': 'center', 'justify-content': 'center'}),
             dbc.Col([
 
@@ -1192,7 +1887,8 @@ app.layout = dbc.Container([
                         'circle',
                         'concentric',
                         'breadthfirst',
-                        'cose'
+                        'cose',
+                        'preset'
                     ),
                     optionHeight=25,
                     value='concentric',
@@ -1246,6 +1942,30 @@ app.layout = dbc.Container([
                     style={'width': '8vw', 'height': '3vh', 'margin': '4px', 'align-items': 'center', 'justify-content': 'center'},
                 ),
 
+                html.Hr(),
+
+                html.B('Group People', style={'textAlign': 'center', 'margin': '4px', 'justify-content': 'center'}),
+                dcc.Dropdown(
+                    id='dropdown-person-grouping',
+                    options=[{'label': 'Individuals', 'value': 'none'}] + [{'label': label, 'value': value} for value, label in PERSON_GROUPINGS.items()],
+                    optionHeight=25,
+                    value='none',
+                    clearable=False,
+                    style={'width': '8vw', 'height': '3vh', 'margin': '4px', 'align-items': 'center', 'justify-content': 'center'},
+                ),
+
+                html.B('Group Stores', style={'textAlign': 'center', 'margin': '4px', 'justify-content': 'center'}),
+                dcc.Dropdown(
+                    id='dropdown-store-grouping',
+                    options=[{'label': 'Individual Stores', 'value': 'none'}] + [{'label': label, 'value': value} for value, label in STORE_GROUPINGS.items()],
+                    optionHeight=25,
+                    value='none',
+                    clearable=False,
+                    style={'width': '8vw', 'height': '3vh', 'margin': '4px', 'align-items': 'center', 'justify-content': 'center'},
+                ),
+                # Groups of the aggregated network expanded into their members in this session
+                dcc.Store(id='network-expanded', data=[]),
+
                 html.Hr(),                
 
                 dbc.Button("Reset Network",
@@ -1419,41 +2139,59 @@ def split_filter_part(filter_part):
     return [None] * 3
 
 
-keys = trajectories['person_id'].unique()
-legend_tracker = dict(zip(keys, [True] * len(keys)))
-keys_stores = stores['Type'].unique()
+@lru_cache(maxsize=256)
+def compile_filter_query(filter_query):
+    '''
+    Parse a DataTable filter_query into its clauses, a tuple of (column, operator, value), once per query string
+    '''
+    clauses = []
+    for filter_part in filter_query.split(' && '):
+        col_name, operator, filter_value = split_filter_part(filter_part)
+        if operator in ('eq', 'ne', 'lt', 'le', 'gt', 'ge', 'contains', 'datestartswith'):
+            clauses.append((col_name, operator, filter_value))
+    return tuple(clauses)
+
+
+def filter_mask(df, filter_query):
+    '''
+    Evaluate every clause of a filter_query on a data-frame into a single boolean mask of the rows matching all of them
+    '''
+    mask = np.ones(len(df), dtype=bool)
+    for col_name, operator, filter_value in compile_filter_query(filter_query):
+        if operator in ('eq', 'ne', 'lt', 'le', 'gt', 'ge'):
+            # these operators match pandas series operator method names
+            clause = getattr(df[col_name], operator)(filter_value)
+        elif operator == 'contains':
+            clause = df[col_name].str.contains(filter_value, na=False)
+        else:
+            # this is a simplification of the front-end filtering logic,
+            # only works with complete fields in standard format
+            clause = df[col_name].str.startswith(filter_value, na=False)
+        mask &= clause.to_numpy(dtype=bool)
+    return mask
+
+
+# Which person trajectories are activated is kept per session in the 'legend-tracker' store, as a list of the person_id's deactivated
 legend_tracker_stores = dict(zip(keys_stores, [True] * len(keys_stores)))
 
 
 @app.callback(
-    # Change output table, 2-D map, and 3-D line plot
-    # return objects in the order each Output is listed
-    Output('individuals-sorting-filtering', 'data'),
-    Output('table-sorting-filtering', 'data'),
-    Output('table-paging-with-map', 'figure'),
-    Output('map-3d', 'figure'),
+    # Recompute which people, stores, and time range are shown, along with the counters derived from them alone
+    # The filter state is only written when it changes, so the tables and maps that depend on it are only updated when they have to be
+    Output('filter-state', 'data'),
     Output('physical_counter', 'children'),
     Output('virtual_counter', 'children'),
     Output('hybrid_counter', 'children'),
-    Output('cytoscape', 'elements'),
-    Input('individuals-sorting-filtering', 'page_current'),
-    Input('individuals-sorting-filtering', 'page_size'),
-    Input('individuals-sorting-filtering', 'sort_by'),
+    Output('legend-tracker', 'data'),
     Input('individuals-sorting-filtering', 'filter_query'),
-    Input('table-sorting-filtering', 'page_current'),
-    Input('table-sorting-filtering', 'page_size'),
-    Input('table-sorting-filtering', 'sort_by'),
     Input('table-sorting-filtering', 'filter_query'),
-    Input('map_2d_dropdown', 'value'),
     Input('map-3d', 'restyleData'),
-    Input('map-3d', 'clickData'),
-    #Input('table-paging-with-map', 'restyleData'),
     Input('input-range', 'startDate'),
     Input('input-range', 'endDate'),
-    # Input('table-toggle', 'n_clicks'),
-    # Input('map-3d', 'clickData')
+    State('filter-state', 'data'),
+    State('legend-tracker', 'data'),
 )
-def update_table_map(page_current_ind, page_size_ind, sort_by_ind, filter_query_ind, page_current, page_size, sort_by, filter_query, map_2d_dropdown_value, restyleData3d, clickData3d, startDate, endDate):
+def update_filter_state(filter_query_ind, filter_query, restyleData3d, startDate, endDate, filter_state, legend_off):
 
     # if clickData:
     #     person_id = clickData['points'][0]['hovertext']
@@ -1463,6 +2201,7 @@ def update_table_map(page_current_ind, page_size_ind, sort_by_ind, filter_query_
     
     # Track which person trajectories are activated in the 3d Plot
     # Users can click each trace in the legend to activate/deactivate them
+    legend_tracker = {person: person not in (legend_off or []) for person in keys.tolist()}
     if restyleData3d is not None:
         edits, indices = restyleData3d
         try:
@@ -1496,37 +2235,13 @@ def update_table_map(page_current_ind, page_size_ind, sort_by_ind, filter_query_
         
     # Retrieve all unique person_id's of activated trajectories as a list we'll pass to the 'od' data-frame as well to the accompanying attribute table
     trajectories_on = [k for k,v in legend_tracker.items() if v == True]    
+    legend_off = [k for k,v in legend_tracker.items() if v != True]
 
     
     
     # INDIVIDUALS TABLE
-    # Enable filtering
-    filtering_expressions_ind = filter_query_ind.split(' && ')
-    individuals_filter = individuals.copy()
-    individuals_filter = individuals_filter[individuals_filter['person_id'].isin(trajectories_on)]
-    for filter_part in filtering_expressions_ind:
-        col_name, operator, filter_value = split_filter_part(filter_part)
-
-        if operator in ('eq', 'ne', 'lt', 'le', 'gt', 'ge'):
-            # these operators match pandas series operator method names
-            individuals_filter = individuals_filter.loc[getattr(individuals_filter[col_name], operator)(filter_value)]
-        elif operator == 'contains':
-            individuals_filter = individuals_filter.loc[individuals_filter[col_name].str.contains(filter_value, na=False)]
-        elif operator == 'datestartswith':
-            # this is a simplification of the front-end filtering logic,
-            # only works with complete fields in standard format
-            individuals_filter = individuals_filter.loc[individuals_filter[col_name].str.startswith(filter_value, na=False)]
-
-            
-    if len(sort_by):
-        individuals_filter = individuals_filter.sort_values(
-            [col['column_id'] for col in sort_by_ind],
-            ascending=[
-                col['direction'] == 'asc'
-                for col in sort_by_ind
-            ],
-            inplace=False
-        )
+    # Enable filtering; the whole query is applied as one mask
+    individuals_filter = individuals[individuals['person_id'].isin(trajectories_on).to_numpy() & filter_mask(individuals, filter_query_ind)]
 
 
     # Datetimepicker has some issues with setting UTC timezone
@@ -1547,72 +2262,114 @@ def update_table_map(page_current_ind, page_size_ind, sort_by_ind, filter_query_
     # Condition 2: A person's ending time availability has to be earlier than or equal to the end date of the timerange picker
     # Condition 3: A person has enough time for travel and activity to visit a specific store (i.e. they have enough time given their space-time constraints)
     # Condition 4: A person's trajectory has to be visible/activated in the 3d-plot
-    unique_storeplus = list(od[(od['free_time_start'] >= startDate) & (od['free_time_end'] <= endDate) & (od['can_visit_spacetime']) & (od['person_id'].isin(individuals_filter['person_id'].unique()))]['store_PlusCode'].unique())
-
-    # # Track which stores are activated in the 2d Map
-    # # Users can click each type of store in the legend to activate/deactivate them
-    # if restyleData2d is not None:
-    #     edits_2d, indices_2d = restyleData2d
-    #     try:
-    #         # The length of indices is equal to one if we only select/unselect one trace
-    #         if len(indices_2d) == 1:
-    #             for visible_2d, index_2d in zip(edits_2d['visible'], indices_2d):
-    #                 if visible_2d == 'legendonly':
-    #                     legend_tracker_stores[list(legend_tracker_stores)[index_2d]] = False
-    #                 else:
-    #                     legend_tracker_stores[list(legend_tracker_stores)[index_2d]] = True
-    #         # Otherwise, the length of indices will be all traces
-    #         else:
-    #             # edits_2d['visible'] contains values for each legend group
-    #             # values are either True or 'legendonly'
-    #             # True means that the legend group is activated
-    #             # 'legendonly' means that the legend group is not activated
-    #             for position, item in enumerate(edits_2d['visible'][:len(keys_stores)]):
-    #                 # If the trace is not activated
-    #                 if item == 'legendonly':
-    #                     # In the person_id legend tracker, set the person_id to False
-    #                     legend_tracker_stores[list(legend_tracker_stores)[position]] = False
-    #                 elif item == True or item == 'True':
-    #                     # Otherwise, the trace is activated so set the person_id to True
-    #                     legend_tracker_stores[list(legend_tracker_stores)[position]] = True
-    #     except KeyError:
-    #         pass
-    # # Retrieve all unique store types activated in the map as a list we'll pass to the accompanying attribute table
-    # stores_on = [k for k,v in legend_tracker_stores.items() if v == True]
+    # Conditions 1-4 are answered by intersecting the precomputed person x store bitsets of the access index
+    reach = query_access_index(access_index, startDate, endDate, individuals_filter['person_id'].unique())
+    unique_storeplus = list(reachable_stores(access_index, reach))
 
     
     ## STORES TABLE
                 
-    # Enable filtering for the table            
-    filtering_expressions = filter_query.split(' && ')
-    stores_filter = stores[(stores['PlusCode'].isin(unique_storeplus))].copy()
-    stores_filter = stores_filter[stores_table_columns]
-    stores_person = stores[stores_table_columns].copy()
-    for filter_part in filtering_expressions:
-        col_name, operator, filter_value = split_filter_part(filter_part)
+    # Enable filtering for the table
+    # The query is evaluated once; the stores reachable by the people shown are the subset of the matching stores that are also reachable
+    stores_mask = filter_mask(stores_table, filter_query)
+    stores_filter = stores_table[stores_mask & stores_table['PlusCode'].isin(unique_storeplus).to_numpy()]
+    stores_person = stores_table[stores_mask]
+        
+    # If anyone is digitally literate, we'll add all stores that can be accessed online and are not already included in the filtered table
+    # The chain names of online stores are computed once at startup
+    stores_online_person = stores_online[stores_online['PlusCode'].isin(stores_person['PlusCode'])]
 
-        if operator in ('eq', 'ne', 'lt', 'le', 'gt', 'ge'):
-            # these operators match pandas series operator method names
-            stores_filter = stores_filter.loc[getattr(stores_filter[col_name], operator)(filter_value)]
-            stores_person = stores_person.loc[getattr(stores_person[col_name], operator)(filter_value)]
-        elif operator == 'contains':
-            stores_filter = stores_filter.loc[stores_filter[col_name].str.contains(filter_value, na=False)]
-            stores_person = stores_person.loc[stores_person[col_name].str.contains(filter_value, na=False)]
-        elif operator == 'datestartswith':
-            # this is a simplification of the front-end filtering logic,
-            # only works with complete fields in standard format
-            stores_filter = stores_filter.loc[stores_filter[col_name].str.startswith(filter_value, na=False)]
-            stores_person = stores_person.loc[stores_person[col_name].str.startswith(filter_value, na=False)]
+    if 'yes' in individuals_filter['digitallit'].unique():
+        stores_online_missing = pd.Index(stores_online_person['PlusCode']).difference(stores_filter.index, sort=False)
+        stores_filter = pd.concat([stores_filter, stores_table.loc[stores_online_missing]])
+
+
+    # Update Network Data
+    od_modality, all_opps, stores_physical_pluscode, stores_virtual_pluscode, stores_hybrid_pluscode = access_index_modalities(access_index, reach, individuals_filter['person_id'].unique(), stores_filter['PlusCode'].unique(), stores_online_person['PlusCode'])
+
+    # Everything shown in the tables and maps follows from the filtered people, the filtered stores (in table order), their opportunities, and the time range
+    # Timestamps are kept as strings so that the state can be stored in the browser (NaT round-trips as 'NaT')
+    new_filter_state = {'person_ids': individuals_filter['person_id'].tolist(),
+                        'store_codes': stores_filter['PlusCode'].tolist(),
+                        'online_codes': stores_online_person['PlusCode'].tolist(),
+                        'opps': [[person] + opps for person, opps in all_opps.items()],
+                        'startDate': str(startDate),
+                        'endDate': str(endDate)}
+    cache_modalities(new_filter_state, od_modality)
+    # Only the legend tracker has to be saved if nothing shown changed
+    if new_filter_state == filter_state:
+        return no_update, no_update, no_update, no_update, legend_off
+    
+    # Updated total accessible physical, virtual, and hybrid stores by all
+    physical_opp_total = len(stores_physical_pluscode)
+    virtual_opp_total = len(stores_virtual_pluscode)
+    hybrid_opp_total = len(stores_hybrid_pluscode)
+
+    return new_filter_state, physical_opp_total, virtual_opp_total, hybrid_opp_total, legend_off
+
+
+# Person - store opportunities (od_modality) of recent filter states, classified once by update_filter_state; least recently used entries are evicted first
+MODALITY_CACHE_SIZE = 32
+modality_cache = OrderedDict()
+
+def cache_modalities(filter_state, od_modality):
+    '''
+    Keep the person - store opportunities classified for a filter state so that callbacks depending on it need not classify them again
+    '''
+    key = json.dumps(filter_state, sort_keys=True)
+    modality_cache[key] = od_modality
+    modality_cache.move_to_end(key)
+    if len(modality_cache) > MODALITY_CACHE_SIZE:
+        modality_cache.popitem(last=False)
+
+def filter_state_modalities(filter_state):
+    '''
+    Retrieve the person - store opportunities of a filter state along with the opportunities of every person
+    
+    They are classified by update_filter_state; they are only classified again here if this worker did not (or no longer) keep them
+    '''
+    key = json.dumps(filter_state, sort_keys=True)
+    if key in modality_cache:
+        modality_cache.move_to_end(key)
+    else:
+        _, stores_filter, startDate, endDate = filter_state_frames(filter_state)
+        reach = query_access_index(access_index, startDate, endDate, filter_state['person_ids'])
+        cache_modalities(filter_state, access_index_modalities(access_index, reach, filter_state['person_ids'], stores_filter['PlusCode'].unique(), filter_state['online_codes'])[0])
+    return modality_cache[key], {opps[0]: opps[1:] for opps in filter_state['opps']}
+
+
+def filter_state_individuals(filter_state):
+    '''
+    Retrieve the filtered individuals of a filter state along with their opportunities
+    '''
+    individuals_filter = individuals[individuals['person_id'].isin(filter_state['person_ids'])]
+    
+    # For every person, based on the available stores after all filtering, add up the total number of physical and virtual opportunities accessible to them and update the respective opportunity fields for each visible individual
+    all_opps_df = pd.DataFrame([opps[1:] for opps in filter_state['opps']], index=[opps[0] for opps in filter_state['opps']], columns=['PhysicalOpp', 'VirtualOpp', 'HybridOpp'])
+    return pd.merge(individuals_filter.drop(columns=['PhysicalOpp', 'VirtualOpp', 'HybridOpp']), all_opps_df, left_on='person_id', right_on=all_opps_df.index, how='left')
+
+
+def filter_state_stores(filter_state):
+    '''
+    Retrieve the filtered stores of a filter state in table order
+    '''
+    # PlusCodes are unique, so looking stores up by PlusCode keeps the table order
+    return stores_table.loc[filter_state['store_codes']].reset_index(drop=True)
+
+
+def filter_state_frames(filter_state):
+    '''
+    Retrieve the filtered individuals (with their opportunities), the filtered stores (in table order), and the time range of a filter state
+    '''
+    return filter_state_individuals(filter_state), filter_state_stores(filter_state), pd.Timestamp(filter_state['startDate']), pd.Timestamp(filter_state['endDate'])
+
+
+def sort_table(df, sort_by):
+    '''
+    Sort the rows of a table by the columns (and directions) of a DataTable's sort_by
+    '''
     if len(sort_by):
-        stores_filter = stores_filter.sort_values(
-            [col['column_id'] for col in sort_by],
-            ascending=[
-                col['direction'] == 'asc'
-                for col in sort_by
-            ],
-            inplace=False
-        )      
-        stores_person = stores_person.sort_values(
+        df = df.sort_values(
             [col['column_id'] for col in sort_by],
             ascending=[
                 col['direction'] == 'asc'
@@ -1620,50 +2377,214 @@ def update_table_map(page_current_ind, page_size_ind, sort_by_ind, filter_query_
             ],
             inplace=False
         )
-        
-    # If anyone is digitally literate, we'll add all stores that can be accessed online and are not already included in the filtered table
-    stores_online = get_online_stores(stores_person)
+    return df
 
-    if 'yes' in individuals_filter['digitallit'].unique():
-        for i_so, r_so in stores_online.iterrows():
-            if r_so['PlusCode'] not in stores_filter['PlusCode']:
-                stores_filter = stores_filter.append(stores[stores_table_columns][stores['PlusCode'] == r_so['PlusCode']])  
 
+# Filtered and sorted rows of the tables, keyed by table, filter state, and sort order; least recently used entries are evicted first
+TABLE_CACHE_SIZE = 32
+table_cache = OrderedDict()
 
-    # Update Network Data
-    cy_edges, cy_nodes, all_opps, stores_physical_pluscode, stores_virtual_pluscode, stores_hybrid_pluscode = network_data(od[(od['free_time_start'] >= startDate) & (od['free_time_end'] <= endDate) & (od['can_visit_spacetime']) & (od['person_id'].isin(individuals_filter['person_id'].unique())) & (od['store_PlusCode'].isin(stores_filter['PlusCode'].unique()))], individuals_filter, stores_filter, stores_online)
+def table_page(table, filter_state, sort_by, page_current, page_size):
+    '''
+    Retrieve the records of one page of a table along with the total number of pages and the page shown
+    
+    Rows are filtered and sorted once per filter state and sort order, so moving to another page only slices the cached rows;
+    a page beyond the last one (e.g., after a filter leaves fewer rows) shows the last page instead
+    '''
+    key = (table, json.dumps(filter_state, sort_keys=True), json.dumps(sort_by, sort_keys=True))
+    if key in table_cache:
+        table_cache.move_to_end(key)
+        rows = table_cache[key]
+    else:
+        rows = filter_state_individuals(filter_state) if table == 'individuals' else filter_state_stores(filter_state)
+        rows = sort_table(rows, sort_by)
+        table_cache[key] = rows
+        if len(table_cache) > TABLE_CACHE_SIZE:
+            table_cache.popitem(last=False)
+    
+    page_count = max(1, -(-len(rows) // page_size))
+    page_current = min(max(page_current or 0, 0), page_count - 1)
+    return rows.iloc[page_current * page_size:(page_current + 1) * page_size].to_dict('records'), page_count, page_current
 
-    # Updated total accessible physical, virtual, and hybrid stores by all
-    physical_opp_total = len(stores_physical_pluscode)
-    virtual_opp_total = len(stores_virtual_pluscode)
-    hybrid_opp_total = len(stores_hybrid_pluscode)
+
+@app.callback(
+    Output('individuals-sorting-filtering', 'data'),
+    Output('individuals-sorting-filtering', 'page_count'),
+    Output('individuals-sorting-filtering', 'page_current'),
+    Input('filter-state', 'data'),
+    Input('individuals-sorting-filtering', 'page_current'),
+    Input('individuals-sorting-filtering', 'page_size'),
+    Input('individuals-sorting-filtering', 'sort_by'),
+)
+def update_individuals_table(filter_state, page_current_ind, page_size_ind, sort_by_ind):
+    if filter_state is None:
+        raise PreventUpdate
+    return table_page('individuals', filter_state, sort_by_ind, page_current_ind, page_size_ind)
+
+
+@app.callback(
+    Output('table-sorting-filtering', 'data'),
+    Output('table-sorting-filtering', 'page_count'),
+    Output('table-sorting-filtering', 'page_current'),
+    Input('filter-state', 'data'),
+    Input('table-sorting-filtering', 'page_current'),
+    Input('table-sorting-filtering', 'page_size'),
+    Input('table-sorting-filtering', 'sort_by'),
+)
+def update_stores_table(filter_state, page_current, page_size, sort_by):
+    if filter_state is None:
+        raise PreventUpdate
+    return table_page('stores', filter_state, sort_by, page_current, page_size)
+
+
+@app.callback(
+    Output('cytoscape', 'elements'),
+    Input('filter-state', 'data'),
+    Input('dropdown-person-grouping', 'value'),
+    Input('dropdown-store-grouping', 'value'),
+    Input('network-expanded', 'data'),
+    State('network-highlights', 'data'),
+)
+def update_network(filter_state, person_grouping, store_grouping, expanded, network_highlights):
+    if filter_state is None:
+        raise PreventUpdate
+    individuals_filter = filter_state_frames(filter_state)[0]
     
-    # For every person, based on the available stores after all filtering, add up the total number of physical and virtual opportunities accessible to them and update the respective opportunity fields for each visible individual
-    all_opps_df = pd.DataFrame.from_dict(all_opps, orient='index', columns=['PhysicalOpp', 'VirtualOpp', 'HybridOpp'])
-    individuals_filter = pd.merge(individuals_filter.drop(columns=['PhysicalOpp', 'VirtualOpp', 'HybridOpp']), all_opps_df, left_on='person_id', right_on=all_opps_df.index, how='left')
+    # Update Network Data from the opportunities classified along with the filter state
+    od_modality, all_opps = filter_state_modalities(filter_state)
+    
+    # Elements keep the highlights set by tapping nodes
+    if person_grouping == 'none' and store_grouping == 'none':
+        cy_edges, cy_nodes = network_data(od_modality, all_opps, individuals_filter, network_highlights)
+    else:
+        cy_edges, cy_nodes = aggregate_network_data(od_modality, individuals_filter,
+                                                    None if person_grouping == 'none' else person_grouping,
+                                                    None if store_grouping == 'none' else store_grouping,
+                                                    expanded or [], network_highlights)
+    return cy_edges + cy_nodes
 
 
-    prisms_filter = prisms[(prisms['person_id'].isin(individuals_filter['person_id'])) & (prisms['free_time_start'] >= startDate) & (prisms['free_time_end'] <= endDate)]
+@app.callback(
+    Output('network-expanded', 'data'),
+    Input('cytoscape', 'tapNode'),
+    Input('dropdown-person-grouping', 'value'),
+    Input('dropdown-store-grouping', 'value'),
+    State('network-expanded', 'data'),
+    prevent_initial_call=True,
+)
+def toggle_network_group(node, person_grouping, store_grouping, expanded):
+    # Changing a grouping collapses every group again
+    if 'cytoscape.tapNode' not in [p['prop_id'] for p in callback_context.triggered]:
+        return []
+    
+    # Tapping a group of the aggregated network expands it into its members
+    if not node or 'group' not in node['classes'].split():
+        raise PreventUpdate
+    return sorted(set(expanded or []) | {node['data']['id']})
 
-    # Update 3D Map
-    map_3d = create_3d_map(trajectories, stores_filter, individuals_filter, individuals)
+
+@app.callback(
+    Output('map-3d', 'figure'),
+    Input('filter-state', 'data'),
+)
+def update_map_3d(filter_state):
+    if filter_state is None:
+        raise PreventUpdate
+    individuals_filter, stores_filter, startDate, endDate = filter_state_frames(filter_state)
     
-    # Filter trajectories that are within the specified timerange
-    trajectories_time = trajectories[(trajectories['daytime'] >= startDate) & (trajectories['daytime'] <= endDate)]
+    # Update 3D Map
+    # Only the visibility of the trajectories and the stores shown change; they are patched in place
+    map_3d = Patch()
+    patch_traces(map_3d, 0, map_3d_visibility(individuals_filter))
+    patch_traces(map_3d, MAP_3D_STORE_TRACE, map_stores(stores_filter, z=MAP_3D_STORES_Z))
+    return map_3d
+
+
+@app.callback(
+    Output('table-paging-with-map', 'figure'),
+    Output('map-2d-view', 'data'),
+    Input('filter-state', 'data'),
+    Input('map_2d_dropdown', 'value'),
+    Input('map-3d', 'clickData'),
+    #Input('table-paging-with-map', 'restyleData'),
+    Input('table-paging-with-map', 'relayoutData'),
+    State('map-2d-view', 'data'),
+)
+def update_map_2d(filter_state, map_2d_dropdown_value, clickData3d, relayoutData2d, map_2d_view):
+    if filter_state is None:
+        raise PreventUpdate
+    # On the initial call nothing in particular triggered the callback, so everything is brought up to date
+    if callback_context.triggered:
+        changed_ids = [p['prop_id'] for p in callback_context.triggered]
+    else:
+        changed_ids = ['filter-state.data', 'map_2d_dropdown.value']
     
     # Update 2D Map
-    map_2d = create_2d_map(map_2d_dropdown_value, individuals_filter, trajectories_time, stores_filter, prisms_filter) 
+    # Only the properties affected by what changed are patched in place
+    map_2d = Patch()
     
-    # Hovering over a store point, county line, or trajectory line in the 3d map focuses the 2d map on that particular location 
-    if clickData3d:
-        map_2d.update_layout(
-            mapbox_zoom = 14,
-            mapbox_center = {'lat': [d['y'] for d in clickData3d['points']][0], 'lon':[d['x'] for d in clickData3d['points']][0]},
-        )
+    # Match the level of detail of its geometries to the zoom the map will be shown at, and only send the stores and polygons
+    # within a region around its viewport; zooming or panning the 2-D map only updates it when the level of detail has to change
+    # or the viewport leaves the region sent
+    map_2d_lod, map_2d_region = map_2d_view['lod'], map_2d_view['region']
+    if changed_ids == ['table-paging-with-map.relayoutData']:
+        map_2d_zoom = (relayoutData2d or {}).get('mapbox.zoom')
+        viewport = mapbox_viewport(relayoutData2d)
+        new_lod = map_2d_lod if map_2d_zoom is None else level_of_detail(map_2d_zoom)
+        if viewport is not None and (new_lod != map_2d_lod or not region_contains(map_2d_region, viewport)):
+            new_region = viewport_region(viewport)
+        else:
+            new_region = map_2d_region
+        if new_lod == map_2d_lod and new_region == map_2d_region:
+            raise PreventUpdate
+    # Clicking a store point or trajectory point in the 3d map focuses the 2d map on that particular location,
+    # zoomed out enough to also show the nearest store, and names the block group the location is in
+    elif 'map-3d.clickData' in changed_ids and clickData3d:
+        lon, lat = clickData3d['points'][0]['x'], clickData3d['points'][0]['y']
+        x_scale = np.cos(np.radians(lat))
+        nearest = stores.iloc[nearest_spatial_index(stores_spatial_index, lon, lat, x_scale=x_scale)]
+        # Largest zoom (at most 14) whose viewport, at half its size, still contains the nearest store
+        d_lon, d_lat = abs(nearest['Longitude'] - lon), abs(nearest['Latitude'] - lat)
+        map_2d_zoom = min([14] + [np.log2(180 / d_lon)] * (d_lon > 0) + [np.log2(90 * x_scale / d_lat)] * (d_lat > 0))
+        new_lod = level_of_detail(map_2d_zoom)
+        new_region = viewport_region(viewport_around(lon, lat, map_2d_zoom))
+        map_2d['layout']['mapbox']['zoom'] = map_2d_zoom
+        map_2d['layout']['mapbox']['center'] = {'lat': lat, 'lon': lon}
+        
+        block_groups = containing_features(knox_bg, knox_bg_spatial_index, lon, lat)
+        # Approximate distance in km (111.32 km per degree of latitude)
+        distance = np.hypot(d_lon * x_scale, d_lat) * 111.32
+        map_2d['layout']['annotations'] = [{
+            'text': ('<b> Block Group:</b> ' + (knox_bg['NAME'].iloc[block_groups[0]] if block_groups else 'Outside Knox County') +
+                     '<br><b> Nearest Store:</b> ' + nearest['Name'] + ' ({:.2f} km)'.format(distance)),
+            'xref': 'paper', 'yref': 'paper', 'x': 0.01, 'y': 0.99, 'xanchor': 'left', 'yanchor': 'top',
+            'align': 'left', 'showarrow': False, 'bgcolor': 'white', 'opacity': 0.9,
+        }]
+    else:
+        new_lod, new_region = map_2d_lod, map_2d_region
+    
+    individuals_filter, stores_filter, startDate, endDate = filter_state_frames(filter_state)
+    
+    if 'filter-state.data' in changed_ids:
+        # Filter trajectories that are within the specified timerange
+        trajectories_time = trajectories.iloc[query_interval_index(trajectories_interval_index, startDate, endDate)]
+        patch_traces(map_2d, MAP_2D_TRAJECTORY_TRACE, map_2d_trajectories(individuals_filter, trajectories_time))
+    if 'filter-state.data' in changed_ids or new_region != map_2d_region:
+        patch_traces(map_2d, MAP_2D_STORE_TRACE, map_stores(stores_in_region(stores_filter, new_region)))
+    
+    # The choropleth changes with the selected layer, its level of detail and region, and, for space-time prisms, the filter state
+    if ('map_2d_dropdown.value' in changed_ids or new_lod != map_2d_lod or new_region != map_2d_region
+            or ('filter-state.data' in changed_ids and map_2d_dropdown_value == 'Space Time Prisms')):
+        prisms_filter = prisms.iloc[query_interval_index(prisms_interval_index, startDate, endDate)]
+        prisms_filter = prisms_filter[prisms_filter['person_id'].isin(individuals_filter['person_id'])]
+        # Block group layers share their geometries, so switching between them at the same level of detail and region only sends the new values
+        geometry = not (is_block_group_layer(map_2d_view.get('layer')) and is_block_group_layer(map_2d_dropdown_value)
+                        and new_lod == map_2d_lod and new_region == map_2d_region)
+        patch_traces(map_2d, MAP_2D_CHOROPLETH_TRACE, [map_2d_choropleth(map_2d_dropdown_value, prisms_filter, new_lod, new_region, geometry)])
         
     #map_toolbar = plotlymap.Canvas(map_2d).toolbar_widget
 
-    return individuals_filter.to_dict('records'), stores_filter.to_dict('records'), map_2d, map_3d, physical_opp_total, virtual_opp_total, hybrid_opp_total, cy_edges + cy_nodes
+    return map_2d, {'lod': new_lod, 'region': new_region, 'layer': map_2d_dropdown_value}
 
     
 # @app.callback(Output('tap-node-json-output', 'children'),
@@ -1677,193 +2598,95 @@ def update_table_map(page_current_ind, page_size_ind, sort_by_ind, filter_query_
 #     return json.dumps(data, indent=2)
     
 @app.callback(Output('cytoscape', 'layout'),
-              [Input('dropdown-layout', 'value')])
-def update_cytoscape_layout(layout):
-    return {'name': layout}
+              [Input('dropdown-layout', 'value'),
+               Input('cytoscape', 'elements'),
+               State('cytoscape', 'layout')])
+def update_cytoscape_layout(layout, elements, current_layout):
+    # Browser layouts are only re-run when chosen; the preset layout is recomputed on the server for every new network topology
+    if layout != 'preset':
+        new_layout = {'name': layout}
+    else:
+        new_layout = network_layout(elements, current_layout)
+    if new_layout == current_layout:
+        raise PreventUpdate
+    return new_layout
 
 
 @app.callback(Output('cytoscape', 'stylesheet'),
+              Output('cytoscape', 'elements', allow_duplicate=True),
+              Output('network-highlights', 'data'),
               Input('cytoscape', 'tapNode'),
               State('cytoscape', 'elements'),
 #               Input('input-follower-color', 'value'),
 #               Input('input-following-color', 'value'),
               Input('dropdown-person-shape', 'value'),
               Input('dropdown-store-shape', 'value'),
-              Input('reset-network', 'n_clicks')
+              Input('reset-network', 'n_clicks'),
+              State('network-highlights', 'data'),
+              prevent_initial_call=True,
     )
-def generate_stylesheet(node, elements, person_shape, store_shape, n_clicks): # follower_color, following_color,
+def generate_stylesheet(node, elements, person_shape, store_shape, n_clicks, highlights): # follower_color, following_color,
     #print(json.dumps(node, indent = 2))
     #print(json.dumps(elements, indent = 2))
 
     if not node:
-        return default_stylesheet
-    
-    stylesheet = [{
-        'selector': '.person',
-        'style': {
-            'shape': person_shape,
-            'opacity': 0.2,
-        }
-    },  {
-        'selector': '.store',
-        'style': {
-            'shape': store_shape,
-            'opacity': 0.2,
-        }
-    }, {
-        'selector': 'edge',
-        'style': {
-            'opacity': 0.0,
-            "curve-style": "bezier",
-            'z-index': 1
-        }
-    }]
+        return default_stylesheet, no_update, no_update
+    # Tapping a group of the aggregated network expands it rather than highlighting it
+    if 'group' in node['classes'].split() and 'cytoscape.tapNode' in [p['prop_id'] for p in callback_context.triggered]:
+        raise PreventUpdate
     
-    global cytoscape_stylesheet
+    # Highlights accumulate per session in the 'network-highlights' store as element id -> highlight classes, and are shown by patching the classes of the elements
+    highlights = {element_id: set(classes) for element_id, classes in (highlights or {}).items()}
+    changed = set()
+    def highlight(element_id, highlight_class):
+        if highlight_class not in highlights.setdefault(element_id, set()):
+            highlights[element_id].add(highlight_class)
+            changed.add(element_id)
     
     # If reset network button is clicked, revert back to default state
     changed_id = [p['prop_id'] for p in callback_context.triggered][0]
     if 'reset-network' in changed_id:
-        cytoscape_stylesheet = []
-        return default_stylesheet
+        changed = set(highlights)
+        highlights = {}
     
     else:        
-        if node['classes'] == 'person':
-            cytoscape_stylesheet.append({
-                'selector': 'node[id = "{}"]'.format(node['data']['id']),
-                'style': {
-                    'background-color': indiv_colors[int(node['data']['id'])],
-                    "border-color": "purple",
-                    "border-width": 2,
-                    "border-opacity": 1,
-                    "opacity": 1,
-
-                    'label': "data(label)",
-                    "text-opacity": 1,
-                    'font-family': 'Roboto',                    
-                    "font-size": 40,
-                    "width": "data(node_size)",
-                    "height": "data(node_size)",
-                    'z-index': 9999
-                }
-            })
-            
-        if node['classes'] == 'store':
-            cytoscape_stylesheet = [style_dict for style_dict in cytoscape_stylesheet if not (style_dict['selector'] == 'node[id = "{}"]'.format(node['data']['id']))]
-            cytoscape_stylesheet.append({
-                'selector': 'node[id = "{}"]'.format(node['data']['id']),
-                'style': {
-                    'background-color': store_colors[stores[stores['PlusCode'] == node['data']['id']]['Type'].values[0]],
-                    'border-color': '#D2F6D0',
-                    'border-width': 2,
-                    'border-opacity': 1,
-                    'opacity': 1,
-
-                    'label': 'data(label)',
-                    'text-opacity': 1,
-                    'font-family': 'Roboto',                    
-                    'font-size': 40,
-                    'color': 'black',
-                    'z-index': 9999,
-                    "width": "data(node_size)",
-                    "height": "data(node_size)",
-                }
-            })
-                
+        highlight(node['data']['id'], 'tapped')
         
+        # The edges of the tapped node carry their own modality, so highlighting them is linear in the node's degree
         for edge in node['edgesData']:
 
             # if you click person: you get edges to other stores (mainly); look at the target for all edge connections
             # if you click store: you get edges to other people (mainly); look at the source for all edge connections
 
-            color_class = next((item['classes'] for i, item in enumerate(cy_edges) if (str(item['data']['source']) == str(edge['source'])) & (str(item['data']['target']) == str(edge['target']))), None)
+            color_class = edge.get('modality')
 
             if (color_class is None) | (color_class == 'self'):
-                # cytoscape_stylesheet.append({
-                #     'selector': 'node[id = "{}"]'.format(edge['target']),
-                #     'style': {
-                #         'background-color': 'grey',
-                #         'opacity': 0.0,
-                #         "label": str(edge['target']),
-                #         "color": "#B10DC9",
-                #         "text-opacity": 1,
-                #         "font-size": 30,
-                #         'z-index': 9999
-                #     }
-                # })
-                next
-            else:    
-                if node['classes'] == 'person':
-                    # If the connected node is a person
-                    if edge['target'].isdigit():
-                        
-                        # A person can also be a target when they're connected to another person, so find out which one the current person is; we want to label both connected nodes
-                        connected_node = edge['source']
-                        if node['data']['id'] == edge['source']:
-                            connected_node = edge['target']                            
-                            
-                        cytoscape_stylesheet.append({
-                            'selector': f"node[id = '{connected_node}']",
-                            'style': {
-                                'background-color': indiv_colors[int(connected_node)],
-                                'opacity': 0.9,
-                                "label": 'Person ' + connected_node,
-                                "width": "data(node_size)",
-                                "height": "data(node_size)",
-                                "color": "black",
-                                "text-opacity": 1,
-                                'font-family': 'Roboto',                                
-                                "font-size": 30,
-                                'z-index': 9999
-                            }
-                        })
-                    # Else, the connected node is a store    
-                    else:
-                        cytoscape_stylesheet.append({
-                            'selector': 'node[id = "{}"]'.format(edge['target']),
-                            'style': {
-                                'background-color': store_colors[stores[stores['PlusCode'] == edge['target']]['Type'].values[0]],
-                                'opacity': 0.9,
-                                "label": f"{stores[stores['PlusCode'] == edge['target']]['Name'].values[0]} {edge['target']}",
-                                "width": "data(node_size)",
-                                "height": "data(node_size)",
-                                "color": "black",
-                                "text-opacity": 1,
-                                'font-family': 'Roboto',                                
-                                "font-size": 30,
-                                'z-index': 9999
-                            }
-                        })
-
-                elif node['classes'] == 'store':
-                    cytoscape_stylesheet.append({
-                        'selector': 'node[id = "{}"]'.format(edge['source']),
-                        'style': {
-                            'background-color': indiv_colors[int(edge['source'])],
-                            'opacity': 0.9,
-                            "label": 'Person ' + edge['source'],
-                            "color": 'black',
-                            "width": "data(node_size)",
-                            "height": "data(node_size)",
-                            "text-opacity": 1,
-                            'font-family': 'Roboto',
-                            "font-size": 30,
-                            'z-index': 9999
-                        }
-                    })
-
-                cytoscape_stylesheet.append({
-                    "selector": 'edge[id= "{}"]'.format(edge['id']),
-                    "style": {
-                        "mid-target-arrow-color": edge_colors[color_class],
-                        "mid-target-arrow-shape": "vee",
-                        "line-color": edge_colors[color_class],
-                        'opacity': 0.9,
-                        'z-index': 9999
-                    }
-                })            
-
-        return stylesheet + cytoscape_stylesheet
+                continue
+            
+            if node['classes'].split()[0] == 'person':
+                # A person can also be a target when they're connected to another person, so find out which one the current person is; we want to label both connected nodes
+                connected_node = edge['target']
+                if edge['target'].isdigit() and node['data']['id'] == edge['target']:
+                    connected_node = edge['source']
+            else:
+                connected_node = edge['source']
+            
+            highlight(connected_node, 'connected')
+            highlight(edge['id'], 'highlighted')
+    
+    # Patch the classes of the elements whose highlights changed
+    patched_elements = Patch()
+    if changed:
+        positions = {element['data']['id']: position for position, element in enumerate(elements)}
+        for element_id in changed:
+            if element_id in positions:
+                element = elements[positions[element_id]]
+                # Keep every base class (e.g., 'store group' of an aggregated node) and replace only the highlight classes
+                base_classes = [c for c in element['classes'].split() if c not in HIGHLIGHT_CLASSES]
+                patched_elements[positions[element_id]]['classes'] = ' '.join(base_classes + [c for c in HIGHLIGHT_CLASSES if c in highlights.get(element_id, ())])
+    
+    stylesheet = network_stylesheet(person_shape, store_shape, focused=bool(highlights))
+    return stylesheet, patched_elements, {element_id: sorted(classes) for element_id, classes in highlights.items()}
     
 # From: https://github.com/plotly/dash-sample-apps/blob/f44f386e890c72846e39a871cde06a58f2367b5c/apps/dash-image-segmentation/app.py#L115    
 # Callback for modal popup
@@ -1890,5 +2713,37 @@ def toggle_navbar_collapse(n, is_open):
     return is_open
 
 
+# What-if scenario API: POST a JSON body such as
+# {"scenarios": [{"name": "Close Kroger", "changes": [{"type": "close_stores", "store_codes": ["..."]}]}], "startDate": "2022-03-11", "endDate": "2022-03-12"}
+# to re-score the opportunities of every person under every scenario at once (see evaluate_scenarios); dates are optional.
+# Invalid scenarios, e.g. extending free time beyond the what-if horizon recorded in the OD manifest, are answered with a 400
+MAX_SCENARIOS = 256
+
+@server.route('/api/scenarios', methods=['POST'])
+def scenarios_api():
+    body = flask.request.get_json(silent=True) or {}
+    scenarios = body.get('scenarios') or []
+    if not isinstance(scenarios, list) or len(scenarios) > MAX_SCENARIOS:
+        return flask.jsonify({'error': f'Expected a list of at most {MAX_SCENARIOS} scenarios'}), 400
+    try:
+        start = pd.to_datetime(body['startDate']) if body.get('startDate') else None
+        end = pd.to_datetime(body['endDate']) if body.get('endDate') else None
+        # The baseline (no changes) is scored along with the scenarios
+        person_opps, counters = evaluate_scenarios(access_index, [[]] + [scenario.get('changes') or [] for scenario in scenarios],
+                                                   stores_online['PlusCode'], start, end)
+    except (AttributeError, KeyError, TypeError, ValueError) as e:
+        return flask.jsonify({'error': str(e)}), 400
+    
+    def scenario_result(i, name):
+        return {'name': name,
+                'counters': dict(zip(['physical', 'virtual', 'hybrid'], counters[i].tolist())),
+                'change': dict(zip(['physical', 'virtual', 'hybrid'], (counters[i] - counters[0]).tolist())),
+                'people': {str(person): dict(zip(['PhysicalOpp', 'VirtualOpp', 'HybridOpp'], opps))
+                           for person, opps in zip(access_index['person_ids'].tolist(), person_opps[i].tolist())}}
+    
+    return flask.jsonify({'baseline': scenario_result(0, 'Baseline'),
+                          'scenarios': [scenario_result(i + 1, scenario.get('name', f'Scenario {i + 1}')) for i, scenario in enumerate(scenarios)]})
+
+
 if __name__ == '__main__':
     app.run_server(debug=True, use_reloader=False)
@@ -0,0 +1,294 @@
+import argparse
+import hashlib
+import json
+import os
+import xml.etree.ElementTree as ET
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+
+from preprocess import DATA_DIR, OD_STORE, file_hash, load_stores, replace_file
+
+#############################################################################################
+# Build the OD (person free-time window x store) travel times offline
+# For every free-time window of every person, a store can be visited in space-time if traveling from where the person is
+# at the start of the window to the store, shopping, and traveling on to their next fixed activity fits within the window.
+# Travel times are shortest paths over a local road network graph (e.g., saved from osmnx with ox.save_graphml) whose
+# node ids match the node_id_o/node_id_d of the trajectories.
+# Run `python od_builder.py --graph <graph.graphml>` to (re)build the OD store read by preprocess.load_od; only the rows of
+# people and stores that changed since the last build are recomputed (`--full` recomputes every row).
+
+# Speeds of every travel mode in km/h; travel times are shortest-path lengths divided by the speed of the mode
+MODE_SPEEDS = {'walk': 4.8, 'bike': 16, 'transit': 20, 'drive': 40}
+# Minutes spent shopping at a store
+SHOPPING_MINUTES = 15
+# Number of shortest-path sources searched per task
+CHUNK_SIZE = 64
+# Minutes beyond every window that travel times are still recorded for, so that what-if scenarios can extend free time by up to as much
+WHAT_IF_MINUTES = 60
+# Columns of the OD store
+OD_COLUMNS = ['person_id', 'store_PlusCode', 'free_time_start', 'free_time_end', 'travel_mode', 'travel_time', 'spare_time', 'can_visit_spacetime']
+
+
+def read_graphml(path):
+    '''
+    Read the nodes (id, x, y) and edges (source, target, length in meters) of a road network graph in GraphML, e.g., saved by osmnx
+
+    Undirected graphs are returned with every edge in both directions.
+    '''
+    ns = {'g': 'http://graphml.graphdrawing.org/xmlns'}
+    root = ET.parse(path).getroot()
+    keys = {(key.get('for'), key.get('attr.name')): key.get('id') for key in root.findall('g:key', ns)}
+    graph = root.find('g:graph', ns)
+
+    def attribute(element, kind, name):
+        data = element.find(f"g:data[@key='{keys.get((kind, name))}']", ns)
+        return None if data is None else data.text
+
+    nodes = pd.DataFrame([{'id': node.get('id'), 'x': float(attribute(node, 'node', 'x')), 'y': float(attribute(node, 'node', 'y'))}
+                          for node in graph.findall('g:node', ns)])
+    edges = pd.DataFrame([{'source': edge.get('source'), 'target': edge.get('target'), 'length': float(attribute(edge, 'edge', 'length'))}
+                          for edge in graph.findall('g:edge', ns)])
+    if graph.get('edgedefault') == 'undirected':
+        edges = pd.concat([edges, edges.rename(columns={'source': 'target', 'target': 'source'})], ignore_index=True)
+    return nodes, edges
+
+
+def road_network(nodes, edges):
+    '''
+    Build the sparse adjacency matrix (in meters) of a road network; parallel edges keep their shortest length
+    '''
+    node_index = pd.Series(np.arange(len(nodes)), index=nodes['id'])
+    edges = edges.assign(source=node_index.reindex(edges['source']).to_numpy(),
+                         target=node_index.reindex(edges['target']).to_numpy()).dropna(subset=['source', 'target'])
+    # csr_matrix sums duplicate entries, so parallel edges are reduced to their shortest first
+    edges = edges.groupby(['source', 'target'], as_index=False)['length'].min()
+    # Zero-length edges would be dropped as missing by csr_matrix
+    lengths = np.maximum(edges['length'].to_numpy(dtype=float), 1e-3)
+    return csr_matrix((lengths, (edges['source'].astype(int), edges['target'].astype(int))), shape=(len(nodes), len(nodes)))
+
+
+def nearest_nodes(nodes, lon, lat):
+    '''
+    Retrieve the position of the road network node nearest every point
+    '''
+    # Scale longitudes so that degrees of longitude and latitude are comparable
+    x_scale = np.cos(np.radians(nodes['y'].mean()))
+    tree = cKDTree(np.column_stack([nodes['x'].to_numpy() * x_scale, nodes['y'].to_numpy()]))
+    return tree.query(np.column_stack([np.asarray(lon) * x_scale, np.asarray(lat)]))[1]
+
+
+def free_time_windows(trajectories):
+    '''
+    Retrieve every free-time window of every person from their trajectories: each run of consecutive non-fixed activities
+
+    A window starts at the start of its first activity and ends at the end of its last one; the person starts at the origin node of
+    its first activity and has to reach the node of the next fixed activity (or the end of their trajectory) by its end, by the first
+    mode they travel with during the window (driving if they do not travel).
+    '''
+    trajectories = trajectories.sort_values(['person_id', 'sequence'], kind='stable').reset_index(drop=True)
+    free = (trajectories['fixed_activity'] == 'n').to_numpy()
+    person = trajectories['person_id'].to_numpy()
+    run_starts = np.r_[True, (free[1:] != free[:-1]) | (person[1:] != person[:-1])]
+    runs = np.cumsum(run_starts) - 1
+
+    free_rows = trajectories[free].assign(run=runs[free])
+    grouped = free_rows.groupby('run', sort=True)
+    first, last = grouped.head(1).set_index('run'), grouped.tail(1).set_index('run')
+    # The row after each window belongs to the next fixed activity if it is of the same person
+    after = np.searchsorted(runs, last.index.to_numpy(), side='right')
+    has_next = after < len(trajectories)
+    has_next[has_next] = person[after[has_next]] == last['person_id'].to_numpy()[has_next]
+    destinations = np.where(has_next, trajectories['node_id_o'].to_numpy()[np.minimum(after, len(trajectories) - 1)], last['node_id_d'].to_numpy())
+
+    modes = free_rows[free_rows['travel_type'] != 'stay'].groupby('run')['travel_type'].first().reindex(first.index).fillna('drive')
+
+    return pd.DataFrame({'person_id': first['person_id'].to_numpy(),
+                         'free_time_start': pd.to_datetime(first['time']).to_numpy(),
+                         'free_time_end': pd.to_datetime(last['time_shift']).to_numpy(),
+                         'node_o': first['node_id_o'].to_numpy(),
+                         'node_d': destinations,
+                         'travel_type': modes.to_numpy()}).dropna(subset=['free_time_start', 'free_time_end'])
+
+
+# Road network (and its reverse) of every worker process, set once by init_worker rather than sent with every task
+worker_graphs = {}
+
+def init_worker(graph):
+    worker_graphs['forward'] = graph
+    worker_graphs['reverse'] = graph.T.tocsr()
+
+def shortest_paths(task):
+    '''
+    Shortest-path lengths from a chunk of sources to the store nodes, searching no farther than limit (meters)
+
+    Paths are searched on the reverse graph for distances to the sources (e.g., from stores to the next fixed activity)
+    '''
+    direction, sources, limit, store_nodes = task
+    lengths = dijkstra(worker_graphs[direction], directed=True, indices=sources, limit=limit)
+    return direction, sources, lengths[:, store_nodes]
+
+
+def source_tasks(direction, sources, limits, store_nodes, chunk_size=CHUNK_SIZE):
+    '''
+    Split the sources searched in a direction into chunks of sources with similar limits, each searched with the largest limit of its chunk
+    '''
+    limits = pd.Series(limits).groupby(sources).max().sort_values()
+    for i in range(0, len(limits), chunk_size):
+        chunk = limits.iloc[i:i + chunk_size]
+        yield direction, chunk.index.to_numpy(), chunk.max(), store_nodes
+
+
+def window_od(windows, stores, nodes, graph, processes=None, shopping_minutes=SHOPPING_MINUTES, chunk_size=CHUNK_SIZE):
+    '''
+    Compute whether every store can be visited in space-time in every given free-time window
+
+    Shortest paths are searched once per distinct origin (forward) and destination (on the reverse graph), in parallel, stopping at
+    the longest distance any window they belong to could cover.
+    '''
+    if len(windows) == 0 or len(stores) == 0:
+        return pd.DataFrame(columns=OD_COLUMNS)
+    node_index = pd.Series(np.arange(len(nodes)), index=nodes['id'])
+    store_nodes = nearest_nodes(nodes, stores['Longitude'], stores['Latitude'])
+
+    # Windows starting or ending off the road network can reach no store
+    windows = windows.copy()
+    windows['source_o'] = node_index.reindex(windows['node_o'].astype(str)).to_numpy()
+    windows['source_d'] = node_index.reindex(windows['node_d'].astype(str)).to_numpy()
+    minutes = (windows['free_time_end'] - windows['free_time_start']).dt.total_seconds() / 60 - shopping_minutes
+    # Farthest (meters) a person can travel in total during each window
+    speeds = windows['travel_type'].map(MODE_SPEEDS).fillna(MODE_SPEEDS['drive']).to_numpy() * 1000 / 60
+    windows['limit'] = np.maximum(minutes, 0) * speeds
+    # Farthest shortest paths are searched, up to WHAT_IF_MINUTES beyond each window
+    windows['search_limit'] = np.maximum(minutes + WHAT_IF_MINUTES, 0) * speeds
+    on_network = windows.dropna(subset=['source_o', 'source_d'])
+
+    tasks = list(source_tasks('forward', on_network['source_o'].astype(int).to_numpy(), on_network['search_limit'].to_numpy(), store_nodes, chunk_size))
+    tasks += list(source_tasks('reverse', on_network['source_d'].astype(int).to_numpy(), on_network['search_limit'].to_numpy(), store_nodes, chunk_size))
+
+    lengths = {'forward': {}, 'reverse': {}}
+    with Pool(processes, initializer=init_worker, initargs=(graph,)) as pool:
+        for direction, sources, chunk_lengths in pool.imap_unordered(shortest_paths, tasks):
+            lengths[direction].update(zip(sources, chunk_lengths))
+
+    # Total length of every window x store trip: to the store, then on to the next fixed activity
+    no_path = np.full(len(store_nodes), np.inf)
+    to_store = np.array([lengths['forward'].get(source, no_path) for source in windows['source_o'].fillna(-1).astype(int)])
+    from_store = np.array([lengths['reverse'].get(source, no_path) for source in windows['source_d'].fillna(-1).astype(int)])
+    trip_lengths = to_store + from_store
+    can_visit = trip_lengths <= windows['limit'].to_numpy()[:, None]
+    # Chunks search as far as their longest window allows; trips longer than their own window allows (plus WHAT_IF_MINUTES) are left out
+    recorded = trip_lengths <= windows['search_limit'].to_numpy()[:, None]
+    travel_time = np.where(recorded, trip_lengths / speeds[:, None], np.nan)
+
+    return pd.DataFrame({'person_id': np.repeat(windows['person_id'].to_numpy(), len(stores)),
+                         'store_PlusCode': np.tile(stores['PlusCode'].to_numpy(), len(windows)),
+                         'free_time_start': np.repeat(windows['free_time_start'].to_numpy(), len(stores)),
+                         'free_time_end': np.repeat(windows['free_time_end'].to_numpy(), len(stores)),
+                         'travel_mode': np.repeat(windows['travel_type'].to_numpy(), len(stores)),
+                         # Minutes traveling to the store and on to the next fixed activity, and minutes to spare (negative if the window is too short)
+                         'travel_time': travel_time.ravel(),
+                         'spare_time': (minutes.to_numpy()[:, None] - travel_time).ravel(),
+                         'can_visit_spacetime': can_visit.ravel()},
+                        columns=OD_COLUMNS)
+
+
+def content_hashes(df, key, columns):
+    '''
+    SHA-256 hash of the given columns of all rows of every key value (e.g., of the free-time windows of every person), keyed by the value as a string
+    '''
+    row_hashes = pd.util.hash_pandas_object(df[columns], index=False).to_numpy()
+    keys = df[key].astype(str).to_numpy()
+    if len(keys) == 0:
+        return {}
+    # Rows are grouped by key once with a stable sort (keeping their order within every key), so every key hashes one contiguous slice
+    order = np.argsort(keys, kind='stable')
+    row_hashes, keys = row_hashes[order], keys[order]
+    bounds = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1], True])
+    return {keys[first]: hashlib.sha256(row_hashes[first:last].tobytes()).hexdigest() for first, last in zip(bounds[:-1], bounds[1:])}
+
+
+def build_od(graph_path, processes=None, shopping_minutes=SHOPPING_MINUTES, chunk_size=CHUNK_SIZE, previous=None):
+    '''
+    Compute whether every store can be visited in space-time in every free-time window of every person, along with the manifest of
+    content hashes (of the road network and settings, of the free-time windows of every person, and of the location of every store) it was computed from
+
+    Given the OD and manifest of a previous build (see read_od), only the rows of people whose free-time windows changed and of stores
+    that moved (or were added) are recomputed; rows of people or stores that were removed are dropped. Everything is recomputed if the road
+    network or settings changed.
+    '''
+    nodes, edges = read_graphml(graph_path)
+    graph = road_network(nodes, edges)
+
+    stores = load_stores().drop_duplicates('PlusCode')
+    windows = free_time_windows(pd.read_csv(os.path.join(DATA_DIR, 'Scenarios_Synthetic_Data_Trajectories.csv'), index_col=0))
+
+    settings = json.dumps({'graph': file_hash(graph_path), 'speeds': MODE_SPEEDS, 'shopping_minutes': shopping_minutes,
+                           'what_if_minutes': WHAT_IF_MINUTES, 'columns': OD_COLUMNS}, sort_keys=True)
+    # The what-if horizon is also recorded as is, so that the app knows how far free time can be extended (see app.evaluate_scenarios)
+    manifest = {'settings': hashlib.sha256(settings.encode()).hexdigest(),
+                'what_if_minutes': WHAT_IF_MINUTES,
+                'people': content_hashes(windows, 'person_id', list(windows.columns)),
+                'stores': content_hashes(stores, 'PlusCode', ['PlusCode', 'Longitude', 'Latitude'])}
+
+    if previous is None or previous[1].get('settings') != manifest['settings']:
+        od = window_od(windows, stores, nodes, graph, processes, shopping_minutes, chunk_size)
+    else:
+        previous_od, previous_manifest = previous
+        changed_people = {p for p, h in manifest['people'].items() if previous_manifest['people'].get(p) != h}
+        changed_stores = {s for s, h in manifest['stores'].items() if previous_manifest['stores'].get(s) != h}
+        window_people, store_codes = windows['person_id'].astype(str), stores['PlusCode']
+
+        # Rows of unchanged people and stores are kept as they are
+        previous_people = previous_od['person_id'].astype(str)
+        kept = previous_od[previous_people.isin(manifest['people']) & ~previous_people.isin(changed_people)
+                           & previous_od['store_PlusCode'].isin(manifest['stores']) & ~previous_od['store_PlusCode'].isin(changed_stores)]
+        # Changed people are recomputed with every store, unchanged people only with the changed stores
+        od = pd.concat([kept,
+                        window_od(windows[window_people.isin(changed_people)], stores, nodes, graph, processes, shopping_minutes, chunk_size),
+                        window_od(windows[~window_people.isin(changed_people)], stores[store_codes.isin(changed_stores)], nodes, graph, processes, shopping_minutes, chunk_size)])
+
+    # Rows are kept in a fixed order so that incremental and full builds give the same store
+    od = od.astype({'person_id': int, 'can_visit_spacetime': bool, 'travel_time': float, 'spare_time': float})
+    od = od.sort_values(['person_id', 'free_time_start', 'store_PlusCode'], kind='stable').reset_index(drop=True)
+    return od, manifest
+
+
+def read_od(path=os.path.join(DATA_DIR, OD_STORE)):
+    '''
+    Read the OD and manifest of a previous build, or None if there is none
+    '''
+    try:
+        with open(path + '.manifest.json') as f:
+            manifest = json.load(f)
+        return pd.read_parquet(path), manifest
+    except (OSError, ValueError):
+        return None
+
+
+def write_od(od, manifest, path=os.path.join(DATA_DIR, OD_STORE)):
+    '''
+    Write the OD to a Parquet store and its manifest, through temporary files so that a partially written store is never read
+
+    The manifest is written last; a store newer than its manifest only causes rows to be needlessly recomputed by the next build
+    '''
+    replace_file(path, lambda tmp_path: od.to_parquet(tmp_path, index=False))
+    def write_manifest(tmp_path):
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+    replace_file(path + '.manifest.json', write_manifest)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the OD travel times of every free-time window of every person to every store')
+    parser.add_argument('--graph', required=True, help='road network graph (GraphML) whose node ids match node_id_o/node_id_d of the trajectories')
+    parser.add_argument('--processes', type=int, default=None, help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--shopping-minutes', type=float, default=SHOPPING_MINUTES, help='minutes spent shopping at a store')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='shortest-path sources searched per task')
+    parser.add_argument('--full', action='store_true', help='recompute every row rather than only those of changed people and stores')
+    args = parser.parse_args()
+    previous = None if args.full else read_od()
+    write_od(*build_od(args.graph, args.processes, args.shopping_minutes, args.chunk_size, previous))
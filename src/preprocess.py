@@ -0,0 +1,619 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+from collections import defaultdict
+import pandas as pd
+import geopandas as gpd
+import numpy as np
+from pyproj import Geod
+from scipy.spatial import cKDTree
+from shapely.geometry import MultiPolygon, Polygon
+
+#############################################################################################
+# Load and preprocess data
+# Preprocessed frames are written to a binary columnar (Parquet) cache so that every worker
+# can start up by reading the cache instead of parsing and preprocessing the source files.
+# Run `python preprocess.py` to (re)build the cache as a build step.
+
+DATA_DIR = '../Data'
+CACHE_DIR = os.path.join(DATA_DIR, 'cache')
+CACHE_MANIFEST = os.path.join(CACHE_DIR, 'manifest.json')
+
+# Bump whenever the preprocessing below changes so existing caches are rebuilt
+CACHE_VERSION = 6
+
+# Levels of detail of map geometries, keyed by the minimum mapbox zoom each level is shown at
+# Values are the tolerances (in degrees, roughly a pixel at that zoom) used to simplify geometries; 0 keeps the full resolution
+LEVELS_OF_DETAIL = {0: 0.002, 10: 0.0005, 12: 0.0001, 14: 0}
+
+# Source files the cached frames are derived from; the cache is rebuilt whenever any of their hashes change
+SOURCE_FILES = ['All_Food_Stores_Features.csv',
+                'Store_Chains.csv',
+                'People_Synthetic_Data.csv',
+                'Scenarios_Synthetic_Data_Trajectories.csv',
+                'Knox_County_BG_Census.shp',
+                'Knox_County_BG_Census.dbf']
+
+# OD travel-time store written by od_builder.py; the precomputed OD_v2.csv is read instead when it has not been built
+OD_STORE = 'OD.parquet'
+
+
+def od_source():
+    '''
+    Source file of the OD travel times: the store built by od_builder.py if there is one, otherwise OD_v2.csv
+    '''
+    return OD_STORE if os.path.exists(os.path.join(DATA_DIR, OD_STORE)) else 'OD_v2.csv'
+
+
+def od_what_if_minutes():
+    '''
+    Minutes beyond every free-time window up to which the OD store built by od_builder.py records trips (from its manifest),
+    or 0 when there is no such store (OD_v2.csv records no minutes to spare)
+    '''
+    try:
+        with open(os.path.join(DATA_DIR, OD_STORE + '.manifest.json')) as f:
+            return json.load(f).get('what_if_minutes', 0)
+    except (OSError, ValueError):
+        return 0
+
+
+# Space-time prisms written by prism_engine.py; the static Scenario_Flexible_Space_Time_Prisms shapefile is read instead when they have not been built
+PRISMS_STORE = 'Prisms.parquet'
+
+
+def prisms_sources():
+    '''
+    Source files of the space-time prisms: the store built by prism_engine.py if there is one, otherwise the static shapefile
+    '''
+    if os.path.exists(os.path.join(DATA_DIR, PRISMS_STORE)):
+        return [PRISMS_STORE]
+    return ['Scenario_Flexible_Space_Time_Prisms.shp', 'Scenario_Flexible_Space_Time_Prisms.dbf']
+
+
+def store_chains(names):
+    '''
+    Canonicalize store names into the chain they belong to (e.g., every Publix into 'Publix Super Market'), or NaN for independent stores
+    
+    Chains are matched in a single pass by a compiled alternation of the name patterns listed in Store_Chains.csv (Pattern, Chain);
+    patterns are plain substrings, so new chains (or new spellings of a chain) only need a row in the file
+    '''
+    chains = pd.read_csv(os.path.join(DATA_DIR, 'Store_Chains.csv'))
+    pattern_chains = dict(zip(chains['Pattern'], chains['Chain']))
+    # Longer patterns first so that a pattern containing another one takes precedence
+    patterns = sorted(pattern_chains, key=len, reverse=True)
+    chain_regex = re.compile('(' + '|'.join(re.escape(pattern) for pattern in patterns) + ')')
+    return names.str.extract(chain_regex, expand=False).map(pattern_chains)
+
+
+# Determine online options
+def get_online_stores(df):
+    '''
+    Retrieve the stores offering delivery, named by their chain when they belong to one (see store_chains)
+    '''
+    stores_online = df.loc[df['Delivery'] == 'Yes', ['Name', 'PlusCode', 'Delivery']].copy()
+    stores_online['Name'] = df['Chain'].reindex(stores_online.index).fillna(stores_online['Name'])
+    
+    #stores_online.drop_duplicates(['Name'], inplace=True, ignore_index=True)
+    
+    return stores_online
+
+
+def load_stores():
+    # Grocery Stores scraped from Google Maps
+    stores = pd.read_csv(os.path.join(DATA_DIR, 'All_Food_Stores_Features.csv'), index_col=0)
+    # Only keep important columns for display
+    stores.rename(columns = {
+        'Descript': 'Description',
+        'G_MAP_URL': 'Google Maps URL',
+        }, inplace=True)
+
+    specific_store_type = stores['Type'].copy()
+    stores.insert(4, 'Specific Type', specific_store_type)
+
+    perceived_columns = ['Convenience', 'Customer Service and Checkout Process', 'Employees', 'Food Departments and Quality', 'Food Selection and Variety']
+    stores[perceived_columns] = stores[perceived_columns].round(2)
+
+    # Condense store types
+    stores['Type'].replace({'Asian grocery store': 'Ethnic grocery store',
+                            'Butcher shop': 'Specialty food store',
+                            'Cafe': 'Ethnic grocery store',
+                            'Dollar store': 'Discount store',
+                            'Discount supermarket': 'Discount store',
+                            'Furniture store': 'Specialty food store',
+                            'Gas station': 'Convenience store',
+                            'Gourmet grocery store': 'Ethnic grocery store',
+                            'Health food store': 'Grocery store',
+                            'Lunch restaurant': 'Specialty food store',
+                            'Market': 'Convenience store',
+                            'Mexican grocery store': 'Ethnic grocery store',
+                            'Mexican restaurant': 'Ethnic grocery store',
+                            'Produce market': 'Specialty food store',
+                            'Store': 'Convenience store', # Weigel's Farm Stores only
+                            'Supermarket': 'Grocery store',
+                            'Warehouse club': 'Warehouse store'
+                            }, inplace=True)
+    
+    # Chain of every store, computed once
+    stores['Chain'] = store_chains(stores['Name'])
+    return stores
+
+
+def load_od():
+    # Travel times between stops in people's trajectories and stores
+    if od_source() == OD_STORE:
+        od = pd.read_parquet(os.path.join(DATA_DIR, OD_STORE))
+    else:
+        od = pd.read_csv(os.path.join(DATA_DIR, 'OD_v2.csv'), index_col=0)
+    od['free_time_start'] = pd.to_datetime(od['free_time_start'])#.dt.tz_localize('US/Eastern')
+    od['free_time_end'] = pd.to_datetime(od['free_time_end'])#.dt.tz_localize('US/Eastern')
+    return od
+
+
+def load_individuals(od, stores_online):
+    # Individuals' information
+    individuals = pd.read_csv(os.path.join(DATA_DIR, 'People_Synthetic_Data.csv'))
+    individuals.description = individuals.description.str.wrap(30)
+    individuals.description = individuals.description.apply(lambda x: x.replace('\n', '<br>'))
+    # Assume all virtual locations are available to a person from the start
+    physical_opp = od[od['can_visit_spacetime']].groupby('person_id')['store_PlusCode'].nunique().reset_index().rename({'store_PlusCode':'PhysicalOpp'}, axis=1)
+    physical_opp['PhysicalOpp'] = physical_opp['PhysicalOpp'].fillna(0)
+
+    individuals = pd.merge(individuals, physical_opp, left_on='person_id', right_on='person_id', how='left')
+    individuals['VirtualOpp'] = [len(stores_online) if indiv_r['digitallit'] == 'yes' else 0 for indiv_i, indiv_r in individuals.iterrows()]   
+    individuals['PhysicalOpp'] = individuals['PhysicalOpp'].replace(np.nan, 0)
+    individuals['VirtualOpp'] = individuals['VirtualOpp'].replace(np.nan, 0)
+    return individuals
+
+
+def add_speed_direction(traj):
+    '''
+    Compute the speed and direction of movement at every point of every person's trajectory at once
+    
+    Values match movingpandas' Trajectory.add_speed and add_direction: both describe the segment from the previous point of the same person,
+    speed is the geodesic (WGS84) distance in meters per second, direction is the initial compass bearing in degrees,
+    both are 0 when a person did not move, and the first point of each trajectory takes the values of the second.
+    Points must be sorted by person_id and daytime.
+    '''
+    person = traj['person_id'].to_numpy()
+    lon = traj['longitude'].to_numpy(dtype=float)
+    lat = traj['latitude'].to_numpy(dtype=float)
+    seconds = (traj['daytime'].to_numpy(dtype='datetime64[ns]') - np.datetime64(0, 'ns')) / np.timedelta64(1, 's')
+    
+    # Shift every column by one point so each point is paired with the previous point of the same person
+    first = np.r_[True, person[1:] != person[:-1]]
+    prev_lon, prev_lat, prev_seconds = np.roll(lon, 1), np.roll(lat, 1), np.roll(seconds, 1)
+    stationary = first | ((prev_lon == lon) & (prev_lat == lat))
+    
+    # Calculate speed
+    _, _, dist_meters = Geod(ellps='WGS84').inv(prev_lon, prev_lat, lon, lat)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        speed = np.where(stationary, 0.0, dist_meters / (seconds - prev_seconds))
+    
+    # Determine direction of movement
+    lat1, lat2, delta_lon = np.radians(prev_lat), np.radians(lat), np.radians(lon - prev_lon)
+    bearing = np.degrees(np.arctan2(np.sin(delta_lon) * np.cos(lat2), np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(delta_lon)))
+    direction = np.where(stationary, 0.0, (bearing + 360) % 360)
+    
+    # The first point of each trajectory takes the values of the second
+    first_positions = np.flatnonzero(first)
+    speed[first_positions] = speed[first_positions + 1]
+    direction[first_positions] = direction[first_positions + 1]
+    
+    return speed, direction
+
+
+def load_trajectories(individuals):
+    # Main and travel trajectory stops (inclusive of every street)
+    traj = pd.read_csv(os.path.join(DATA_DIR, 'Scenarios_Synthetic_Data_Trajectories.csv'), index_col=0)
+    traj.drop(columns=['time'], inplace=True)
+    traj['person_id'] = traj['person_id'].astype(int)
+
+    # Parse time component (as datetime)
+    traj['daytime'] = pd.to_datetime(traj.pop('datetime'))
+
+    # Sort trajectories by numerical order of person_id and timestamp; like a movingpandas Trajectory, only the first point at a given timestamp is kept
+    traj = traj.sort_values(by=['person_id', 'daytime'], kind='stable')
+    traj = traj[~traj.duplicated(['person_id', 'daytime'], keep='first')]
+    # A trajectory needs at least two points
+    traj = traj[traj.groupby('person_id')['person_id'].transform('size') >= 2]
+
+    # Calculate speed and direction of movement for all people at once
+    speed, direction = add_speed_direction(traj)
+
+    trajectories = gpd.GeoDataFrame(traj.drop(columns=['longitude', 'latitude', 'daytime']),
+                                    geometry=gpd.points_from_xy(traj['longitude'], traj['latitude']),
+                                    crs='epsg:4326')
+    trajectories['speed'] = speed
+    trajectories['direction'] = direction
+    trajectories['daytime'] = traj['daytime']
+
+    # Add longitude and latitude back into data frame
+    trajectories["longitude"] = trajectories["geometry"].x
+    trajectories["latitude"] = trajectories["geometry"].y
+
+    # Merge trajectories and individuals dataset so people's information can be visualized when hovered over in plots
+    trajectories = gpd.GeoDataFrame(pd.merge(trajectories, individuals, left_on='person_id', right_on='person_id'), geometry='geometry', crs=trajectories.crs)
+    return trajectories
+
+
+def douglas_peucker_significance(coords):
+    '''
+    Rank the points of a single trajectory by their Douglas-Peucker significance
+    
+    A point's significance is the tolerance at which Douglas-Peucker would split the trajectory at it (capped by the tolerance of the split above it),
+    so keeping every point above a threshold gives the Douglas-Peucker simplification for that tolerance. Endpoints are always kept.
+    '''
+    significance = np.zeros(len(coords))
+    significance[[0, -1]] = np.inf
+    
+    segments = [(0, len(coords) - 1, np.inf)]
+    while segments:
+        first, last, parent = segments.pop()
+        if last - first < 2:
+            continue
+        
+        # Distance of every point in between to the segment joining the two ends
+        start, seg = coords[first], coords[last] - coords[first]
+        between = coords[first + 1:last] - start
+        seg_len = seg @ seg
+        t = np.clip(between @ seg / seg_len, 0, 1) if seg_len > 0 else np.zeros(len(between))
+        dist = np.linalg.norm(between - t[:, None] * seg, axis=1)
+        
+        # Split at the farthest point and rank both halves below it
+        split = first + 1 + int(np.argmax(dist))
+        significance[split] = min(dist[split - first - 1], parent)
+        segments.append((first, split, significance[split]))
+        segments.append((split, last, significance[split]))
+    
+    return significance
+
+
+# Stores within this distance (meters) of a trajectory keep the trajectory point nearest to them when trajectories are decimated
+STORE_PROXIMITY_RADIUS = 500
+
+
+def add_trajectory_significance(trajectories, stores):
+    '''
+    Rank every trajectory point by how much it contributes to the shape of its trajectory so plots can be decimated to a point budget
+    
+    Significance is Douglas-Peucker in space-time, with longitude, latitude and time each normalized to their range like the axes of the 3-D plot.
+    Stop points (where a person starts or stops moving) and, for every store within STORE_PROXIMITY_RADIUS of a trajectory, the point of that
+    trajectory nearest to the store are always kept.
+    '''
+    lon = trajectories['longitude'].to_numpy(dtype=float)
+    lat = trajectories['latitude'].to_numpy(dtype=float)
+    seconds = (trajectories['daytime'].to_numpy(dtype='datetime64[ns]') - np.datetime64(0, 'ns')) / np.timedelta64(1, 's')
+    coords = np.column_stack([lon, lat, seconds])
+    coords = (coords - coords.min(axis=0)) / np.where(np.ptp(coords, axis=0) > 0, np.ptp(coords, axis=0), 1)
+    
+    # Trajectories are sorted by person_id and daytime so each person's points are one contiguous block
+    person = trajectories['person_id'].to_numpy()
+    bounds = np.flatnonzero(np.r_[True, person[1:] != person[:-1], True])
+    significance = np.concatenate([douglas_peucker_significance(coords[first:last]) for first, last in zip(bounds[:-1], bounds[1:])])
+    
+    # Keep the points where a person starts or stops moving
+    moving = trajectories['speed'].to_numpy() > 0
+    significance[np.flatnonzero(moving[1:] != moving[:-1])] = np.inf
+    significance[np.flatnonzero(moving[1:] != moving[:-1]) + 1] = np.inf
+    
+    # Keep the point of every trajectory nearest to each store near it: all (point, store) pairs within the radius come from the k-d trees
+    # of the points and stores (in degrees of latitude, with longitude scaled), and the nearest point of each (person, store) is the first
+    # of its pairs sorted by distance (the earliest of equally near points)
+    stores_xy = stores[['Longitude', 'Latitude']].dropna().to_numpy(dtype=float)
+    located = np.flatnonzero(np.isfinite(lon) & np.isfinite(lat))
+    if len(located) and len(stores_xy):
+        cos_lat = np.cos(np.radians(lat[located].mean()))
+        points_tree = cKDTree(np.column_stack([lon[located] * cos_lat, lat[located]]))
+        stores_tree = cKDTree(np.column_stack([stores_xy[:, 0] * cos_lat, stores_xy[:, 1]]))
+        # 111,320 m per degree of latitude
+        pairs = points_tree.sparse_distance_matrix(stores_tree, STORE_PROXIMITY_RADIUS / 111320, output_type='ndarray')
+        point, store = located[pairs['i']], pairs['j']
+        order = np.lexsort((point, pairs['v'], store, person[point]))
+        point, store, pair_person = point[order], store[order], person[point[order]]
+        nearest = np.r_[True, (pair_person[1:] != pair_person[:-1]) | (store[1:] != store[:-1])]
+        significance[point[nearest]] = np.inf
+    
+    trajectories['significance'] = significance
+    return trajectories
+
+
+def load_knox_bg():
+    knox_bg = gpd.read_file(os.path.join(DATA_DIR, 'Knox_County_BG_Census.shp'))
+
+    # Scale percentage values between 0 - 100
+    knox_bg_columns=['Unemply',
+                     'NHSDplm',
+                     'Ag65Old',
+                     'Ag17Yng',
+                     'DisblHH',
+                     'SinglHH',
+                     'Minorty',
+                     'PrEngls',
+                     'MltUnts',
+                     'MobilHm',
+                     'Crowdng',
+                     'NoVehcl',
+                     'GropQrt',
+                     'SNAPBnf',
+                     'NoCmptr',
+                     'NIntrnt']
+
+    for c in knox_bg_columns:
+        knox_bg[c] = knox_bg[c] * 100
+
+    knox_bg.rename(columns={'TotlPpE': 'Population',
+                            'Incm_ME': 'Median Income $', 
+                            'Unemply': 'Unemployment %',
+                            'NHSDplm': 'No High School Diploma %',
+                            'Ag65Old': 'Age 65 or Older %',
+                            'Ag17Yng': 'Age 17 or Younger %',
+                            'DisblHH': 'Households with Disabled Person(s) %',
+                            'SinglHH': 'Households with Single Parent %',
+                            'Minorty': 'Non-White Population %',
+                            'PrEngls': 'Speaks English Less than well %',
+                            'MltUnts': 'Multi-Unit Housing %',
+                            'MobilHm': 'Mobile Home Housing %',
+                            'Crowdng': 'Crowded Housing %',
+                            'NoVehcl': 'Households without Vehicles %',
+                            'GropQrt': 'People Living in Group Quarters %',
+                            'SNAPBnf': 'People with SNAP Benefits %',
+                            'NoCmptr': 'People without Computers %',
+                            'NIntrnt': 'People without Internet %'},
+                            inplace=True
+                  )
+
+    return knox_bg
+
+
+def load_prisms():
+    # Space-time prisms shown in the 2-D Map
+    if prisms_sources() == [PRISMS_STORE]:
+        # The reachable nodes of every window are only kept for later builds (see prism_engine.build_prisms)
+        return gpd.read_parquet(os.path.join(DATA_DIR, PRISMS_STORE)).drop(columns=['reach_key', 'reach_limit', 'reach_nodes', 'reach_lengths'], errors='ignore')
+    prisms = gpd.read_file(os.path.join(DATA_DIR, 'Scenario_Flexible_Space_Time_Prisms.shp'), index_col=0)
+    prisms['free_time_start'] = pd.to_datetime(prisms['free_time_'])
+    prisms['free_time_end'] = pd.to_datetime(prisms['free_tim_1'])
+    return prisms
+
+
+def prism_store_opps(prisms, od):
+    '''
+    Number of stores that can be visited in space-time within the free-time window of every prism according to the OD;
+    prisms whose window is not in the OD keep their precomputed StoreOpps
+    '''
+    window_keys = ['person_id', 'free_time_start', 'free_time_end']
+    visits = od.assign(store_visit=od['store_PlusCode'].where(od['can_visit_spacetime'])).groupby(window_keys)['store_visit'].nunique()
+    store_opps = visits.reindex(pd.MultiIndex.from_frame(prisms[window_keys])).to_numpy()
+    return np.where(np.isnan(store_opps), prisms['StoreOpps'], store_opps).astype(int)
+
+
+def simplify_line(coords, tolerance):
+    '''
+    Douglas-Peucker simplification of a line (an array of points), always keeping both of its ends
+    '''
+    keep = np.zeros(len(coords), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(coords) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start, inner, segment = coords[first], coords[first + 1:last], coords[last] - coords[first]
+        # Distance of every inner point to the segment between the ends (to the first end for a closed line)
+        length_sq = segment @ segment
+        t = np.clip((inner - start) @ segment / length_sq, 0, 1) if length_sq > 0 else np.zeros(len(inner))
+        dist = np.hypot(*(inner - start - t[:, None] * segment).T)
+        farthest = np.argmax(dist)
+        if dist[farthest] > tolerance:
+            keep[first + 1 + farthest] = True
+            stack += [(first, first + 1 + farthest), (first + 1 + farthest, last)]
+    return coords[keep]
+
+
+def ring_arcs(points, junctions):
+    '''
+    Cut a ring (a list of distinct points, not closed) into arcs between its junctions; a ring without junctions is a single closed arc
+    started at its smallest point, so that rings tracing the same boundary cut it into the same arcs
+    '''
+    cuts = [i for i, point in enumerate(points) if point in junctions]
+    start = cuts[0] if cuts else points.index(min(points))
+    points = points[start:] + points[:start] + [points[start]]
+    cuts = [cut - start for cut in cuts] + [len(points) - 1] if cuts else [0, len(points) - 1]
+    return [points[a:b + 1] for a, b in zip(cuts[:-1], cuts[1:])]
+
+
+def coverage_simplify(geometries, tolerance):
+    '''
+    Simplify (multi)polygons that share boundaries, e.g. adjacent block groups, without opening gaps or overlaps between them (as TopoJSON does)
+    
+    Rings are cut into arcs at junctions, the points whose neighbors along one ring differ from those along another ring through them;
+    every arc is simplified once and shared by every ring it bounds. Arcs of rings that would collapse, or of polygons that would become
+    invalid, are kept at full resolution. Other geometries are returned as they are.
+    '''
+    # Rings of every polygon as lists of distinct points, along with the position of the geometry the polygon belongs to
+    polygons = []
+    for position, geometry in enumerate(geometries):
+        if geometry is None or geometry.is_empty or geometry.geom_type not in ('Polygon', 'MultiPolygon'):
+            continue
+        for polygon in getattr(geometry, 'geoms', [geometry]):
+            rings = []
+            for ring in [polygon.exterior, *polygon.interiors]:
+                coords = np.asarray(ring.coords)[:-1, :2]
+                coords = coords[np.r_[True, (np.diff(coords, axis=0) != 0).any(axis=1)]]
+                rings.append(list(map(tuple, coords)))
+            polygons.append((position, rings))
+    
+    neighbors = defaultdict(set)
+    for _, rings in polygons:
+        for points in rings:
+            for prev, point, next_point in zip(points[-1:] + points[:-1], points, points[1:] + points[:1]):
+                neighbors[point].add(frozenset((prev, next_point)))
+    junctions = {point for point, pairs in neighbors.items() if len(pairs) > 1}
+    
+    # Every arc is kept once, in a canonical direction; rings refer to their arcs by (canonical arc, whether it is traced reversed)
+    arcs = {}
+    polygon_arcs = []
+    for _, rings in polygons:
+        polygon_arcs.append([])
+        for points in rings:
+            ring = []
+            for arc in ring_arcs(points, junctions):
+                key = min(tuple(arc), tuple(arc[::-1]))
+                arcs.setdefault(key, np.array(key))
+                ring.append((key, key != tuple(arc)))
+            polygon_arcs[-1].append(ring)
+    
+    simplified = {key: simplify_line(coords, tolerance) for key, coords in arcs.items()}
+    while True:
+        results, full = defaultdict(list), set()
+        for (position, _), rings in zip(polygons, polygon_arcs):
+            ring_coords = [np.concatenate([(simplified[key][::-1] if reversed_arc else simplified[key])[:-1] for key, reversed_arc in ring])
+                           for ring in rings]
+            for ring, coords in zip(rings, ring_coords):
+                if len(coords) < 3:
+                    full.update(key for key, _ in ring)
+            polygon = Polygon(ring_coords[0], ring_coords[1:]) if all(len(coords) >= 3 for coords in ring_coords) else None
+            if polygon is None or not polygon.is_valid:
+                full.update(key for ring in rings for key, _ in ring)
+            results[position].append(polygon)
+        # Arcs already at full resolution cannot be restored any further (e.g., of polygons that were invalid to begin with)
+        full = {key for key in full if len(simplified[key]) < len(arcs[key])}
+        if not full:
+            break
+        simplified.update((key, arcs[key]) for key in full)
+    
+    simplified_geometries = list(geometries)
+    for position, position_polygons in results.items():
+        # Geometries with rings degenerate to begin with are kept as they are
+        if None in position_polygons:
+            continue
+        simplified_geometries[position] = position_polygons[0] if geometries[position].geom_type == 'Polygon' else MultiPolygon(position_polygons)
+    return simplified_geometries
+
+
+def layer_lods(gdf):
+    '''
+    Geometries of a choropleth layer at every level of detail (see LEVELS_OF_DETAIL), one row per feature and level ('lod'), indexed like the layer
+    '''
+    lods = []
+    for lod, tolerance in LEVELS_OF_DETAIL.items():
+        geometry = coverage_simplify(list(gdf.geometry), tolerance) if tolerance else list(gdf.geometry)
+        lods.append(gpd.GeoDataFrame({'lod': [lod] * len(gdf)}, index=gdf.index, geometry=geometry, crs=gdf.crs))
+    return pd.concat(lods)
+
+
+def build_frames():
+    '''
+    Load and preprocess every frame from the source files
+    '''
+    stores = load_stores()
+    od = load_od()
+    individuals = load_individuals(od, get_online_stores(stores))
+    prisms = load_prisms()
+    # Opportunities of the static prisms follow the OD built by od_builder.py, along with those of individuals (see load_individuals);
+    # prisms built by prism_engine.py count the stores within them instead
+    if od_source() == OD_STORE and prisms_sources() != [PRISMS_STORE]:
+        prisms['StoreOpps'] = prism_store_opps(prisms, od)
+    knox_bg = load_knox_bg()
+    return {'stores': stores,
+            'od': od,
+            'individuals': individuals,
+            'trajectories': add_trajectory_significance(load_trajectories(individuals), stores),
+            'knox_bg': knox_bg,
+            'prisms': prisms,
+            # Simplified geometries of the choropleth layers of the 2-D Map at every level of detail
+            'knox_bg_lods': layer_lods(knox_bg),
+            'prisms_lods': layer_lods(prisms)}
+
+
+def file_hash(path):
+    '''
+    SHA-256 hash of a file
+    '''
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def source_hashes():
+    '''
+    SHA-256 hash of every source file the cached frames are derived from
+    '''
+    return {source_file: file_hash(os.path.join(DATA_DIR, source_file)) for source_file in SOURCE_FILES + [od_source()] + prisms_sources()}
+
+
+def replace_file(path, write):
+    '''
+    Write a file through write(temporary path) and move it into place in one step, so that a partially written file is never read
+    
+    Every writer gets its own temporary file, so concurrent writers (e.g., several workers rebuilding the cache at once) never clobber each other's
+    '''
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix=os.path.basename(path) + '.', suffix='.tmp', delete=False) as f:
+        tmp_path = f.name
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_cache(frames, hashes):
+    '''
+    Write the preprocessed frames to the Parquet cache; the manifest is written last so that a partially written cache is never read
+    '''
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    for name, frame in frames.items():
+        replace_file(os.path.join(CACHE_DIR, f'{name}.parquet'), frame.to_parquet)
+    
+    manifest = {'version': CACHE_VERSION,
+                'sources': hashes,
+                'geometry': [name for name, frame in frames.items() if isinstance(frame, gpd.GeoDataFrame)]}
+    def write_manifest(tmp_path):
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+    replace_file(CACHE_MANIFEST, write_manifest)
+
+
+def read_cache(hashes):
+    '''
+    Read the preprocessed frames from the Parquet cache, or None if the cache is missing or out of date
+    '''
+    try:
+        with open(CACHE_MANIFEST) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    
+    if manifest.get('version') != CACHE_VERSION or manifest.get('sources') != hashes:
+        return None
+    
+    frames = {}
+    for name in ['stores', 'od', 'individuals', 'trajectories', 'knox_bg', 'prisms', 'knox_bg_lods', 'prisms_lods']:
+        path = os.path.join(CACHE_DIR, f'{name}.parquet')
+        frames[name] = gpd.read_parquet(path) if name in manifest['geometry'] else pd.read_parquet(path)
+    return frames
+
+
+def load_frames(rebuild=False):
+    '''
+    Load the preprocessed frames from the cache, rebuilding the cache first if it is missing, out of date, or a rebuild is requested
+    '''
+    hashes = source_hashes()
+    frames = None if rebuild else read_cache(hashes)
+    if frames is None:
+        frames = build_frames()
+        write_cache(frames, hashes)
+    
+    # Missing values are shown as empty cells in the tables; Parquet stores them as nulls, so this is applied after loading
+    frames['stores'] = frames['stores'].replace({np.nan: None})
+    return frames
+
+
+if __name__ == '__main__':
+    load_frames(rebuild=True)
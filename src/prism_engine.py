@@ -0,0 +1,206 @@
+import argparse
+import hashlib
+import json
+import os
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely.geometry import MultiPoint
+
+from preprocess import DATA_DIR, PRISMS_STORE, file_hash, load_stores, replace_file
+from od_builder import CHUNK_SIZE, MODE_SPEEDS, free_time_windows, init_worker, read_graphml, road_network, shortest_paths, source_tasks
+
+#############################################################################################
+# Build the space-time prisms shown in the 2-D Map
+# The prism of a free-time window is projected onto the map as its potential path area: every road network node a person can reach
+# from where they are at the start of the window and still reach their next fixed activity from by its end, by their travel mode.
+# Shortest paths are searched over the same road network graph as od_builder.py.
+# Run `python prism_engine.py --graph <graph.graphml>` to (re)build the prisms read by preprocess.load_prisms; prisms already built
+# for the same (person, window, travel mode, time budget) are reused. `--budget-scale` scales every time budget for what-if scenarios.
+# The reachable nodes of every window are kept with their trip lengths (searched for at least the unscaled budget), so a scale no larger
+# than that of an earlier build re-thresholds them into new prisms without a new search; only larger budgets are searched again.
+
+# Radius (degrees, about 30 m) of the area around the reachable nodes of a window when they are too few (or collinear) to span a polygon
+DEGENERATE_AREA_RADIUS = 0.0003
+
+
+def prism_keys(windows, settings, columns=('person_id', 'free_time_start', 'free_time_end', 'node_o', 'node_d', 'travel_type', 'limit')):
+    '''
+    Key of the prism of every free-time window: a hash of the road network and settings, the person, the window, its nodes, travel mode and time budget
+
+    Leave 'limit' out of columns for the key of the reachable nodes of a window, whatever its time budget
+    '''
+    columns = list(columns)
+    row_hashes = pd.util.hash_pandas_object(windows[columns], index=False).to_numpy()
+    return [hashlib.sha256(settings.encode() + row_hash.tobytes()).hexdigest() for row_hash in row_hashes]
+
+
+def potential_path_area(points):
+    '''
+    Potential path area spanned by the reachable road network nodes (an array of points) of a window: their convex hull
+    
+    The hull of one node is a Point and of two (or collinear) nodes a LineString; these are buffered by DEGENERATE_AREA_RADIUS
+    so that every area is a polygon that can be drawn in the choropleth and contains the stores at its nodes
+    '''
+    hull = MultiPoint(points).convex_hull
+    if hull.geom_type != 'Polygon':
+        hull = hull.buffer(DEGENERATE_AREA_RADIUS)
+    return hull
+
+
+def reachable_nodes(task):
+    '''
+    Shortest-path lengths from a chunk of sources to every node within limit (meters), as sparse (node positions, lengths) per source
+
+    Only the nodes reached are returned, so neither the workers' results nor the searches kept for later windows cover the whole graph
+    '''
+    direction, sources, lengths = shortest_paths(task)
+    reached = []
+    for source_lengths in lengths:
+        source_nodes = np.flatnonzero(np.isfinite(source_lengths))
+        reached.append((source_nodes.astype(np.int32), source_lengths[source_nodes]))
+    return direction, sources, reached
+
+
+def window_reach(windows, nodes, graph, processes=None, chunk_size=CHUNK_SIZE):
+    '''
+    Find the road network nodes of every free-time window whose trip from the start of the window and on to the next fixed activity
+    is no longer than the window allows (limit, in meters), with the lengths of these trips
+
+    Shortest paths are searched once per distinct origin (forward) and destination (on the reverse graph), in parallel; returns
+    a (node positions, trip lengths) pair per window, both empty for windows starting or ending off the road network.
+    '''
+    node_index = pd.Series(np.arange(len(nodes)), index=nodes['id'])
+    source_o = node_index.reindex(windows['node_o'].astype(str)).to_numpy()
+    source_d = node_index.reindex(windows['node_d'].astype(str)).to_numpy()
+    # Windows starting or ending off the road network have no potential path area
+    on_network = ~(np.isnan(source_o) | np.isnan(source_d))
+    limits = windows['limit'].to_numpy()
+
+    all_nodes = slice(None)
+    tasks = list(source_tasks('forward', source_o[on_network].astype(int), limits[on_network], all_nodes, chunk_size))
+    tasks += list(source_tasks('reverse', source_d[on_network].astype(int), limits[on_network], all_nodes, chunk_size))
+    lengths = {'forward': {}, 'reverse': {}}
+    with Pool(processes, initializer=init_worker, initargs=(graph,)) as pool:
+        for direction, sources, reached in pool.imap_unordered(reachable_nodes, tasks):
+            lengths[direction].update(zip(sources, reached))
+
+    empty = (np.empty(0, dtype=np.int32), np.empty(0))
+    reach = [empty] * len(windows)
+    for window in np.flatnonzero(on_network):
+        forward_nodes, forward_lengths = lengths['forward'][int(source_o[window])]
+        reverse_nodes, reverse_lengths = lengths['reverse'][int(source_d[window])]
+        # Node positions of a source are sorted and unique, so nodes reached both ways are matched by one merge
+        window_nodes, forward_at, reverse_at = np.intersect1d(forward_nodes, reverse_nodes, assume_unique=True, return_indices=True)
+        trip_lengths = forward_lengths[forward_at] + reverse_lengths[reverse_at]
+        within = trip_lengths <= limits[window]
+        reach[window] = (window_nodes[within], trip_lengths[within])
+    return reach
+
+
+def potential_path_areas(reach_nodes, reach_lengths, limits, nodes):
+    '''
+    Compute the potential path area (see potential_path_area) of every free-time window from its reachable nodes and their trip lengths
+    (see window_reach), keeping only the nodes whose trip is no longer than its limit; None for windows that reach no node
+    '''
+    node_points = nodes[['x', 'y']].to_numpy()
+    areas = []
+    for window_nodes, trip_lengths, limit in zip(reach_nodes, reach_lengths, limits):
+        window_nodes = np.asarray(window_nodes)[np.asarray(trip_lengths) <= limit]
+        areas.append(potential_path_area(node_points[window_nodes]) if len(window_nodes) else None)
+    return gpd.GeoSeries(areas, index=limits.index, crs='epsg:4326')
+
+
+def store_opps(areas, stores):
+    '''
+    Number of stores within every potential path area, from one bulk query of the spatial index of the stores
+    '''
+    points = gpd.GeoSeries(gpd.points_from_xy(stores['Longitude'], stores['Latitude']), crs='epsg:4326')
+    drawn = np.flatnonzero(areas.notna().to_numpy() & ~areas.is_empty.to_numpy())
+    # Every intersecting (area, store) pair; bulk queries are query_bulk before geopandas 0.12 and query since
+    sindex = points.sindex
+    area_positions, _ = getattr(sindex, 'query_bulk', sindex.query)(areas.iloc[drawn], predicate='intersects')
+    return np.bincount(drawn[area_positions], minlength=len(areas)).tolist()
+
+
+def build_prisms(graph_path, processes=None, budget_scale=1, chunk_size=CHUNK_SIZE, previous=None):
+    '''
+    Build the space-time prism (potential path area) of every free-time window of every person, with the number of stores within it
+
+    Time budgets are the lengths of the windows (the time_available of their activities) scaled by budget_scale.
+    Prisms of a previous build (see read_prisms) with the same key (see prism_keys) are reused rather than recomputed, and the reachable nodes
+    of its windows are re-thresholded wherever they were searched at least as far as the new budget; only the other windows are searched.
+    '''
+    nodes, edges = read_graphml(graph_path)
+    graph = road_network(nodes, edges)
+    stores = load_stores().drop_duplicates('PlusCode')
+
+    windows = free_time_windows(pd.read_csv(os.path.join(DATA_DIR, 'Scenarios_Synthetic_Data_Trajectories.csv'), index_col=0)).reset_index(drop=True)
+    windows['time_avail'] = ((windows['free_time_end'] - windows['free_time_start']).dt.total_seconds() / 60).round().astype(int)
+    # Farthest (meters) a person can travel in total during each window, and as far as its nodes are searched: at least its unscaled budget,
+    # so that the prisms of any smaller scale can be re-thresholded later
+    base_limit = windows['time_avail'] * windows['travel_type'].map(MODE_SPEEDS).fillna(MODE_SPEEDS['drive']).to_numpy() * 1000 / 60
+    windows['limit'] = base_limit * budget_scale
+    search_limit = np.maximum(windows['limit'], base_limit)
+
+    settings = json.dumps({'graph': file_hash(graph_path), 'speeds': MODE_SPEEDS, 'degenerate_area_radius': DEGENERATE_AREA_RADIUS}, sort_keys=True)
+    windows['prism_key'] = prism_keys(windows, settings)
+    windows['reach_key'] = prism_keys(windows, settings, ['person_id', 'free_time_start', 'free_time_end', 'node_o', 'node_d', 'travel_type'])
+
+    areas = gpd.GeoSeries([None] * len(windows), index=windows.index, crs='epsg:4326')
+    reach = pd.DataFrame({'reach_limit': search_limit, 'reach_nodes': None, 'reach_lengths': None}, index=windows.index)
+    reused = pd.Series(False, index=windows.index)
+    rethresholded = pd.Series(False, index=windows.index)
+    if previous is not None and 'reach_key' in previous:
+        previous = previous.drop_duplicates('reach_key').set_index('reach_key')
+        previous_reach = previous.reindex(windows['reach_key'])
+        # Nodes searched at least as far as the new time budget hold every node of the new prism
+        has_reach = (previous_reach['reach_limit'] >= windows['limit'].to_numpy()).to_numpy()
+        reach.loc[has_reach] = previous_reach.loc[has_reach, reach.columns].to_numpy()
+        reused[:] = has_reach & (previous_reach['prism_key'] == windows['prism_key'].to_numpy()).to_numpy()
+        areas[reused] = previous_reach.geometry[reused.to_numpy()].to_numpy()
+        rethresholded[:] = has_reach & ~reused
+    searched = ~(reused | rethresholded)
+    if searched.any():
+        new_windows = windows[searched].assign(limit=search_limit[searched])
+        new_reach = window_reach(new_windows, nodes, graph, processes, chunk_size)
+        reach.loc[searched, 'reach_nodes'] = pd.Series([window_nodes for window_nodes, _ in new_reach], index=new_windows.index, dtype=object)
+        reach.loc[searched, 'reach_lengths'] = pd.Series([trip_lengths for _, trip_lengths in new_reach], index=new_windows.index, dtype=object)
+    rebuilt = ~reused
+    areas[rebuilt] = potential_path_areas(reach.loc[rebuilt, 'reach_nodes'], reach.loc[rebuilt, 'reach_lengths'], windows.loc[rebuilt, 'limit'], nodes).to_numpy()
+
+    prisms = gpd.GeoDataFrame(pd.concat([windows[['person_id', 'free_time_start', 'free_time_end', 'travel_type', 'time_avail', 'prism_key', 'reach_key']], reach], axis=1),
+                              geometry=areas, crs='epsg:4326')
+    # Stores may have changed since the prisms were built, so they are always counted again
+    prisms['StoreOpps'] = store_opps(prisms.geometry, stores)
+    return prisms
+
+
+def read_prisms(path=os.path.join(DATA_DIR, PRISMS_STORE)):
+    '''
+    Read the prisms of a previous build, or None if there is none
+    '''
+    try:
+        return gpd.read_parquet(path)
+    except (OSError, ValueError):
+        return None
+
+
+def write_prisms(prisms, path=os.path.join(DATA_DIR, PRISMS_STORE)):
+    '''
+    Write the prisms to a (Geo)Parquet store, through a temporary file so that a partially written store is never read
+    '''
+    replace_file(path, prisms.to_parquet)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the space-time prism of every free-time window of every person')
+    parser.add_argument('--graph', required=True, help='road network graph (GraphML) whose node ids match node_id_o/node_id_d of the trajectories')
+    parser.add_argument('--processes', type=int, default=None, help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--budget-scale', type=float, default=1, help='scale of the time budget of every window, for what-if scenarios; scales no larger than that of an earlier build (or 1) re-threshold its reachable nodes without a new search')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='shortest-path sources searched per task')
+    parser.add_argument('--full', action='store_true', help='recompute every prism rather than reusing those already built')
+    args = parser.parse_args()
+    previous = None if args.full else read_prisms()
+    write_prisms(build_prisms(args.graph, args.processes, args.budget_scale, args.chunk_size, previous))